@@ -1,18 +1,10 @@
 import streamlit as st
-import openai
-import whisper
-import pyttsx3
-from transformers import GPT2TokenizerFast
 import speech_recognition as sr
+import re
+import threading
 import time
-import json
-
-import gtts
-from playsound import playsound
-import ffmpeg
-from pydub import AudioSegment
-from pydub.playback import play
-import io
+import uuid
+
 import numpy as np
 
 import os
@@ -20,43 +12,115 @@ os.environ["TOKENIZERS_PARALLELISM"] = "false"
 from dotenv import load_dotenv
 load_dotenv()
 
-openai.api_key = os.getenv("OPENAI_API_KEY")
-TOKENIZER = GPT2TokenizerFast.from_pretrained("gpt2")
-
-with open('cases.json') as f:
-    CASES = json.load(f)
+# after load_dotenv, since these read their settings from the environment on import
+import asr
+import capture
+import casepack
+import llm
+import render
+import speculate
+import tracing
+import transcripts
+import tts
+from feedback import FEEDBACK_PROMPT, RollingFeedback
+from memory import CompactingBuffer, TokenBuffer, count_tokens, get_tokenizer
+
+STREAMING_CAPTURE = os.getenv("STREAMING_CAPTURE", "1") == "1"
+COMPACT_MEMORY = os.getenv("COMPACT_MEMORY", "1") == "1"
+PROMPT_BUDGET = int(os.getenv("PROMPT_BUDGET", "4000"))
+BOOTSTRAP_PROMPT = 'Provide a brief history of the case. Do not give all the information away. If necessary, include the image files within parentheses but do not describe them. Then, on a new line starting with "Question:", ask the examinee a first question based on the instructions and provided case.'
+TURN_PROMPT = 'Respond to the examinee\'s last answer as the examiner. If the examinee asks a question or requests more information, fulfill their request. Do not confirm or acknowledge this request; directly answer the examinee. Always finish with a line starting with "Question:" that asks the examinee about the case or a follow-up question.'
+FOLLOW_UP = 'Can you elaborate on that?'
+OPENERS = ['Thank you.', 'Okay.', 'Good.', 'Correct.', FOLLOW_UP]  # synthesized ahead of time when speculating
+QUESTION_MARKER = re.compile(r'\**Question:\**\s*')
+
+CASES = casepack.get_pack()
+
+
+def start_bootstrap(instructions):
+    # the case history and first question come from one streamed request that starts right away,
+    # so it can be kicked off as soon as a case is picked and consumed once the exam is set up
+    return llm.get_gateway().stream(
+        [{"role": "user", "content": instructions}, {"role": "system", "content": BOOTSTRAP_PROMPT}],
+        temperature=0.5,
+        top_p=1)
 
 
 class Exam:
 
-    def __init__(self, instructions, option):
+    def __init__(self, instructions, option, session_id=None, headless=False, session_history=None, assessments=None,
+                 user=None):
         if os.path.exists("audio.wav"):
             os.remove("audio.wav")
         if os.path.exists("output.mp3"):
             os.remove("output.mp3")
 
         self.option = option.strip().lower()
-        self.engine = pyttsx3.init()
-        self.memory = [{"role": "user", "content": instructions}]
-        self.tokenizer = GPT2TokenizerFast.from_pretrained("gpt2")
-        self.tokens = len(self.tokenizer(instructions)['input_ids'])
-        self.max_tokens = 4000
+        self.case = CASES[self.option]
+        self.instructions = instructions
+        self.llm = llm.get_gateway()
+        self.session_id = session_id or uuid.uuid4().hex
+        self.tracer = tracing.Tracer(self.session_id, self.option)
+        self.max_tokens = PROMPT_BUDGET
+        self.summarized = 0  # stored messages the memory's summary stands in for
+        if COMPACT_MEMORY:
+            # the case instructions stay pinned; older turns are folded into a summary instead of dropped
+            pinned_tokens = self.case.prompt_tokens if instructions == self.case.prompt else None
+            self.memory = CompactingBuffer([{"role": "user", "content": instructions}], self.max_tokens, count_tokens,
+                                           self.summarize, pinned_tokens=pinned_tokens, on_summary=self.save_summary)
+        else:
+            self.memory = TokenBuffer(self.max_tokens, count_tokens, text=lambda message: message['content'],
+                                      items=[{"role": "user", "content": instructions}])
+        # headless sessions replay recorded answers (capture.FixtureSource) and don't play audio
+        self.headless = headless
+        self.play = (lambda clip: None) if headless else tts.play
+        self.session_history = st.session_state.history if session_history is None else session_history
+        if assessments is None:
+            assessments = RollingFeedback(self.llm) if headless else st.session_state.assessments
+        self.assessments = assessments
         self.r = sr.Recognizer()
-        with sr.Microphone() as source:
-            self.r.adjust_for_ambient_noise(source, duration=2.5)
+        # headless sessions keep the default threshold; live ones reuse the microphone's measured noise profile
+        if headless:
+            self.noise = capture.NoiseProfile(self.r.energy_threshold, calibrated=True)
+        else:
+            self.noise = capture.get_noise_profile()
+        self.r.energy_threshold = self.noise.threshold
         self.r.dynamic_energy_threshold = True
-        self.model = whisper.load_model("base")
+        self.transcriber = asr.get_service()
+        # FixtureSource only feeds the streaming capture loop, so headless sessions always use it
+        if STREAMING_CAPTURE or headless:
+            self.capture = capture.StreamingCapture(self.r, self.transcriber, self.noise)
+        else:
+            self.capture = None
+        # drafting needs the live partial transcripts of streaming capture
+        self.speculator = None
+        if speculate.SPECULATE and self.capture:
+            self.speculator = speculate.Speculator(self.llm, self.tracer, TURN_PROMPT,
+                                                   prepare=lambda sentence: QUESTION_MARKER.sub('', sentence),
+                                                   temperature=0.5, top_p=1)
         self.history = []
+        self.llm_calls = 0
+        self.time_to_first_audio = None
+        self.metrics = []
 
-        # from cases json
-        self.images = CASES[self.option.strip().lower()][0]['images'] if len(CASES[self.option.strip().lower()][0]['images']) > 0 else None
+        # headless replays aren't real sessions and aren't stored
+        self.store = None if headless else transcripts.get_store()
+        if self.store:
+            self.resume()
+            self.store.start(self.session_id, self.option, user)
 
     def load_audio(self, file, sr=16000):
         if isinstance(file, bytes):
+            try:
+                return asr.decode_wav(file, sr)
+            except ValueError:
+                pass  # not plain PCM WAV, let ffmpeg handle it
             inp = file
             file = 'pipe:'
         else:
             inp = None
+        import ffmpeg
+
         try:
             out, _ = (
                 ffmpeg.input(file, threads=0)
@@ -69,51 +133,233 @@ class Exam:
 
     def transcribe(self, audio):
         try:
-            return self.model.transcribe(self.load_audio(audio.get_wav_data()), language='en', fp16=False)['text']
+            with self.tracer.span('load_audio'):
+                samples = self.load_audio(audio.get_wav_data())
+            with self.tracer.span('transcribe', audio_seconds=len(samples) / 16000):
+                return self.transcriber.submit(samples).result()
         except:
             return None
 
-    def generate_response(self, prompt, user='user', pop_latest=False):
-        self.update_memory(user, prompt)
-        response = openai.ChatCompletion.create(
-            # model="gpt-3.5-turbo",
-            model='gpt-4',
-            messages=self.memory,
-            temperature=0.5,
-            top_p=1,)['choices'][0]['message']['content']
-        if pop_latest:
-            self.memory.pop()
-        self.update_memory("assistant", response)
-        return response
-
     def generate_response_stream(self, memory):
-        response = openai.ChatCompletion.create(
-            # model="gpt-3.5-turbo",
-            model='gpt-4',
-            messages=memory,
-            temperature=0.5,
-            top_p=1,
-            stream=True)
+        return self.llm.stream(memory, temperature=0.5, top_p=1)
+
+    def stream_response(self, prompt, user='user', pop_latest=False):
+        self.add_prompt(user, prompt, pop_latest)
+        self.llm_calls += 1
+        response = ''
+        try:
+            for delta in self.llm.stream(self.memory.to_list(), temperature=0.5, top_p=1):
+                response += delta
+                yield delta
+        finally:
+            if pop_latest:
+                self.memory.pop()
+            if response:
+                self.update_memory("assistant", response)
+
+    def respond(self, prompt, user='user', pop_latest=False):
+        return self.say(self.stream_response(prompt, user=user, pop_latest=pop_latest))
+
+    def say(self, deltas):
+        # show and speak each sentence as soon as it is complete instead of waiting for the whole reply
+        start = time.perf_counter()
+        first_token = None
+        text = render.StreamRenderer(st.empty(), prefix='Examiner: ')
+        splitter = tts.SentenceSplitter()
+        with tts.SpeechPipeline(start, play=self.play) as speech:
+            try:
+                for delta in deltas:
+                    if first_token is None:
+                        first_token = time.perf_counter()
+                        self.tracer.record('llm_first_token', first_token - start, prompt_tokens=self.memory.tokens)
+                    text.feed(delta)
+                    for sentence in splitter.feed(delta):
+                        speech.put(QUESTION_MARKER.sub('', sentence))
+            except llm.LLMError as e:
+                print(f'examiner request failed: {e}')
+                st.warning('The examiner did not respond. Please answer again or press stop.')
+            response = text.close()
+            self.tracer.record('llm', time.perf_counter() - start, response_tokens=count_tokens(response))
+            self.tracer.record('render', text.render_seconds, **text.stats())
+            for sentence in splitter.flush():
+                speech.put(QUESTION_MARKER.sub('', sentence))
+            self.show_image(response)
+        self.time_to_first_audio = speech.time_to_first_audio
+        if self.time_to_first_audio is not None:
+            self.tracer.record('time_to_first_audio', self.time_to_first_audio)
+        self.tracer.record('tts_synthesis', speech.synthesis_seconds, audio_seconds=speech.audio_seconds)
+        self.tracer.record('speak', time.perf_counter() - start, audio_seconds=speech.audio_seconds)
         return response
 
+    def record_turn(self, llm_calls, seconds):
+        self.metrics.append({
+            'turn': len(self.metrics) + 1,
+            'llm_calls': llm_calls,
+            'seconds': seconds,
+            'time_to_first_audio': self.time_to_first_audio,
+        })
+        self.tracer.record('turn', seconds, llm_calls=llm_calls)
+        self.tracer.turn += 1
+
+    def summarize(self, summary, messages):
+        dialogue = '\n'.join(f"{m['role']}: {m['content']}" for m in messages)
+        prompt = 'Summarize the following part of an oral exam between an examiner (assistant) and an examinee (user) in a few sentences. Keep the questions asked, the gist and accuracy of the examinee\'s answers, hints given, and which image files have already been shown.'
+        if summary:
+            prompt += f'\n\nUpdate this existing summary with the new dialogue:\n{summary}'
+        return self.llm.complete([{'role': 'user', 'content': f'{prompt}\n\nDialogue:\n{dialogue}'}],
+                                 model="gpt-3.5-turbo", temperature=0, background=True)
+
     def speak(self, text):
-        audio = io.BytesIO()
-        gtts.gTTS(text=text).write_to_fp(audio)
-        audio.seek(0)
-        play(AudioSegment.from_file(audio, format="mp3"))
+        self.play(tts.synthesize(text))
 
     def update_memory(self, role, content):
         self.memory.append({"role": role, "content": content})
-        self.tokens += len(self.tokenizer(content)['input_ids'])
-        while self.tokens > self.max_tokens:
-            popped = self.memory.pop(0)
-            self.tokens -= len(self.tokenizer(popped['content'])['input_ids'])
+        if self.store:
+            self.store.append(self.session_id, 'message', role, content)
 
-    def show_image(self, response, imgs_path):
-        if imgs_path:
-            for img_path in imgs_path:
-                if img_path in response:
-                    st.image(img_path, width=400)
+    def add_prompt(self, role, content, transient):
+        # an instruction that is popped again after the reply isn't part of the conversation
+        if transient:
+            self.memory.append({"role": role, "content": content})
+        else:
+            self.update_memory(role, content)
+
+    def add_turn(self, speaker, text):
+        self.history.append(f'{speaker}: {text}')
+        self.session_history.append(f'{speaker}: {text}')
+        if self.store:
+            self.store.append(self.session_id, 'turn', speaker, text)
+
+    def save_summary(self, summary, folded):
+        # the summary and how many stored messages it covers, so resuming doesn't summarize them again
+        self.summarized += folded
+        if self.store:
+            self.store.append(self.session_id, 'summary', str(self.summarized), summary['content'])
+
+    def assess(self, question, answer, note=None):
+        future = self.assessments.add_turn(question, answer, note)
+        if self.store and note is None:
+            number = len(self.assessments)
+            future.add_done_callback(lambda f: self.save_note(number, f))
+
+    def save_note(self, number, future):
+        if not future.cancelled() and future.exception() is None:
+            self.store.append(self.session_id, 'note', str(number), future.result())
+
+    def resume(self):
+        # rebuild the transcript, the LLM memory and the answer assessments from the store instead of asking
+        # the model again
+        messages, summary, notes, question = [], None, {}, ''
+        answers = []
+        for _, kind, role, content in self.store.events(self.session_id):
+            if kind == 'turn':
+                self.history.append(f'{role}: {content}')
+                self.session_history.append(f'{role}: {content}')
+                if role == 'Me':
+                    answers.append((question, content))
+                else:
+                    question = content
+            elif kind == 'message':
+                messages.append({"role": role, "content": content})
+            elif kind == 'summary':
+                summary = (content, int(role))
+            elif kind == 'note':
+                notes[int(role)] = content
+        if summary is not None:
+            self.summarized = summary[1]
+        self.memory.restore(messages, summary)
+        # answers whose note wasn't written before the reload are assessed again, in the background
+        for number, (question, answer) in enumerate(answers, 1):
+            self.assess(question, answer, notes.get(number))
+
+    def show_image(self, response):
+        for ref in self.case.image_refs(response):
+            st.image(self.case.images[ref], width=400)
+
+    def listen(self, source):
+        if self.capture:
+            partial = st.empty()
+            with self.tracer.span('listen') as span:
+                text = self.capture.listen(source, on_partial=lambda t: self.on_partial(partial, t))
+                span['audio_seconds'] = self.capture.audio_seconds
+            # end of speech to final transcript
+            self.tracer.record('endpoint', time.perf_counter() - self.capture.speech_end)
+            partial.empty()
+            if self.speculator and not text:
+                self.speculator.cancel()
+        else:
+            with self.tracer.span('listen'):
+                self.r.energy_threshold = self.noise.threshold
+                audio = self.r.listen(source)
+            self.noise.threshold = self.r.energy_threshold
+            self.noise.calibrated = True
+            text = self.transcribe(audio)
+        return text
+
+    def on_partial(self, placeholder, text):
+        placeholder.write(f'Me: {text} ...')
+        if self.speculator:
+            self.speculator.update(text, self.memory.to_list())
+
+    def run(self, source, stop_button=False, bootstrap=None):
+        first_q = not self.history
+        if self.history:
+            for line in self.history:
+                st.write(line)
+            response = next((line.split(': ', 1)[1] for line in reversed(self.history) if line.startswith('Examiner: ')), '')
+        while True:
+            if stop_button:
+                break
+            if first_q:
+                # history and first question, usually already generating since the case was picked
+                start = time.perf_counter()
+                bootstrap = bootstrap or start_bootstrap(self.instructions)
+                response = self.say(bootstrap)
+                self.record_turn(llm_calls=1, seconds=time.perf_counter() - start)
+                self.update_memory("assistant", response)
+                history, question = (QUESTION_MARKER.split(response, maxsplit=1) + [''])[:2]
+                first_q = False
+                response = question.strip() or history.strip()
+                self.add_turn('Examiner', response)
+                continue
+
+            # user input
+            drafts = self.speculator.drafts if self.speculator else 0
+            try:
+                text = self.listen(source)
+            except EOFError:
+                if self.speculator:
+                    self.speculator.cancel()
+                break  # headless: the recorded answers ran out
+            if text:
+                start = time.perf_counter()
+                self.assess(response, text)
+                self.add_turn('Me', text)
+                st.write(f'Me: {text}')
+
+                # examiner feedback and next question in a single completion
+                calls = self.llm_calls
+                self.update_memory('user', text)
+                draft = None
+                if self.speculator:
+                    draft = self.speculator.take(text)
+                    # every draft started while the resident was talking was a request, used or not
+                    self.llm_calls += self.speculator.drafts - drafts
+                if draft is not None:
+                    # drafted while the resident was still talking
+                    response = self.say([draft])
+                    self.update_memory('assistant', response)
+                else:
+                    response = self.respond(TURN_PROMPT, user='system', pop_latest=True)
+                if not QUESTION_MARKER.search(response) and '?' not in response:
+                    # the model ignored the format; ask a canned follow-up rather than a second round-trip
+                    st.write(f"Examiner: {FOLLOW_UP}")
+                    with self.tracer.span('speak'):
+                        self.speak(FOLLOW_UP)
+                    self.update_memory('assistant', FOLLOW_UP)
+                    response = f'{response} {FOLLOW_UP}'
+                self.add_turn('Examiner', response)
+                self.record_turn(llm_calls=self.llm_calls - calls, seconds=time.perf_counter() - start)
 
     def main(self):
         st.write("**Clinical scenario initialized.** You can end the scenario by clicking the *stop* button.")
@@ -123,49 +369,7 @@ class Exam:
         if st.session_state.feedback_state is False:
             with sr.Microphone() as source:
                 source.pause_threshold = 1  # silence in seconds
-                first_q = True
-                while True:
-                    if stop_button:
-                        break
-                    if first_q:
-                        response = self.generate_response('Provide a brief history of the case. Do not give all the information away. If necessary, include the image files within parentheses but do not describe them.', user='system', pop_latest=True)
-                        self.show_image(response, self.images)
-                        st.write(f"Examiner: {response}")
-                        self.speak(response)
-                        first_q = False
-
-                        # first question
-                        response = self.generate_response('Based on the instructions and provided case, ask a question.', user='system', pop_latest=True)
-                        self.show_image(response, self.images)
-                        self.history.append(f'Examiner: {response}')
-                        update_session_history(f'Examiner: {response}')
-                        st.write(f"Examiner: {response}")
-                        self.speak(response)
-                        continue
-
-                    # user input
-                    audio = self.r.listen(source)
-                    text = self.transcribe(audio)
-                    if text:
-                        print('answering')
-                        self.history.append(f'Me: {text}')
-                        update_session_history(f'Me: {text}')
-                        st.write(f'Me: {text}')
-
-                        # examiner question
-                        response = self.generate_response(response)
-                        self.history.append(f'Examiner: {response}')
-                        update_session_history(f'Examiner: {response}')
-                        self.show_image(response, self.images)
-                        st.write(f"Examiner: {response}")
-                        self.speak(response)
-                        if '?' not in response:
-                            response = self.generate_response('Ask the examinee about the case or ask follow-up questions. Do not confirm or acknowledge this request; directly answer the examinee.', pop_latest=True)
-                            self.history.append(f'Examiner: {response}')
-                            update_session_history(f'Examiner: {response}')
-                            self.show_image(response, self.images)
-                            st.write(f"Examiner: {response}")
-                            self.speak(response)
+                self.run(source, stop_button, bootstrap=st.session_state.pop('bootstrap', None))
         else:
             for i in st.session_state.history:
                 st.write(i)
@@ -177,52 +381,53 @@ class Exam:
         st.write('If you would like feedback, please click the button below.')
         feedback_button = st.button('Get feedback', key='feedback')
         if feedback_button:
-            if len(st.session_state.history) != 0:
-                instructions = 'Based on the chat dialogue between me and the patient, please provide constructive feedback and criticism for the resident ("Me:"), NOT the examiner. Comment on the medical accuracy of responses. Comment on things that were done well, areas for improvement, and other remarks as necessary. Do not make anything up. If the examinee asks a question or requests more information, fulfill their request. Regardless of your initial response, ask the examinee about the case or ask follow-up questions.'
-                temp_mem = [{'role': 'user', 'content': '\n'.join(st.session_state.history) + instructions}]
+            if len(self.assessments) != 0:
+                # each answer was already assessed in the background; only the short synthesis is left
+                stream = self.assessments.synthesize()
+            elif len(st.session_state.history) != 0:
+                temp_mem = [{'role': 'user', 'content': '\n'.join(st.session_state.history) + FEEDBACK_PROMPT}]
                 stream = self.generate_response_stream(temp_mem)
-                t = st.empty()
-                full_response = ''
-                for word in stream:
-                    try:
-                        next_word = word['choices'][0]['delta']['content']
-                        full_response += next_word
-                        t.write(full_response)
-                    except:
-                        pass
-                    time.sleep(0.001)
+            else:
+                stream = None
+            if stream is not None:
+                text = render.StreamRenderer(st.empty())
+                start = time.perf_counter()
+                try:
+                    for delta in stream:
+                        text.feed(delta)
+                except llm.LLMError as e:
+                    print(f'feedback request failed: {e}')
+                    st.warning('Feedback could not be generated. Please try again.')
+                text.close()
+                self.tracer.record('feedback', time.perf_counter() - start, **text.stats())
             else:
                 st.write('No conversation to provide feedback on.')
 
 
 def disable():
     st.session_state.disabled = True
+    # start generating the case history and first question while the exam is being set up
+    if st.session_state.option != "Select one":
+        st.session_state.bootstrap = start_bootstrap(create_prompt(CASES, st.session_state.option))
 
 def feedback():
     st.session_state.feedback_state = True
 
-def update_session_history(prompt):
-    st.session_state.history.append(prompt)
-    tokens = len(TOKENIZER('\n'.join(st.session_state.history))['input_ids'])
-    max_tokens = 8000
-    while tokens > max_tokens:
-        st.session_state.history.pop(0)
+@st.cache_resource
+def warm_up():
+    # load the heavy models in the background while the resident is still choosing a case
+    def load():
+        get_tokenizer()
+        asr.get_service()
+        tts.get_backend()
+        if speculate.SPECULATE:
+            speculate.prewarm(OPENERS)
+    thread = threading.Thread(target=load, daemon=True)
+    thread.start()
+    return thread
 
 def create_prompt(cases, option):
-    instructions = f"Instructions: You are an evaluator for a neurosurgery oral exam. Provide contextual information to the examinee as relevant, as the examinee does not have any information of the case beforehand. Speak as if you were talking the examinee. Treat this as an exam and do not provide words of encouragement. Provide hints if the examinee does not know the answer.\n\nContext:{cases[option.strip().lower()][0]['case_info']}" + "\nPlease write the image files in parentheses if you would like to use them in your questions. You do not need to use these images in the first question unless relevant. If you've already used an image, no need to include it in parentheses."
-    images = cases[option.strip().lower()][0]['images']
-
-    if len(images) > 0:
-        image_prompt = '\n\nImages:\n'
-        for i in range(len(images)):
-            image_prompt += cases[option.strip().lower()][0]['images'][i]
-            image_prompt += ': '
-            image_prompt += cases[option.strip().lower()][0]['img_descriptions'][i]
-            image_prompt += '\n'
-    else:
-        image_prompt = ''
-
-    return instructions + image_prompt
+    return cases[option].prompt
 
 
 if __name__ == '__main__':
@@ -230,25 +435,52 @@ if __name__ == '__main__':
     st.caption('Powered by Whisper, GPT-4, and Google text-to-speech.')
     st.caption('By [Eddie Guo](https://tig3r66.github.io/)')
 
+    warm_up()
+
+    if 'session_id' not in st.session_state:
+        # a reloaded page carries its session in the URL and picks up where it left off
+        st.session_state.session_id = st.query_params.get('session') or uuid.uuid4().hex
+        store = transcripts.get_store()
+        stored = store.session(st.session_state.session_id) if store else None
+        if stored and stored['case'] in CASES:
+            st.session_state.option = stored['case']
+            st.session_state.disabled = True
     if 'history' not in st.session_state:
-        st.session_state.history = []
+        st.session_state.history = TokenBuffer(8000, count_tokens)
+    if 'assessments' not in st.session_state:
+        st.session_state.assessments = RollingFeedback(llm.get_gateway())
     if 'disabled' not in st.session_state:
         st.session_state.disabled = False
     if 'feedback_state' not in st.session_state:
         st.session_state.feedback_state = False
 
+    query, specialty, tags = '', None, []
+    if len(CASES) > 1:
+        # narrow a large case library down before picking
+        search, pick, tag_pick = st.columns([2, 1, 1])
+        query = search.text_input('Search cases', disabled=st.session_state.disabled)
+        specialty = pick.selectbox('Specialty', ('All', *CASES.specialties()), disabled=st.session_state.disabled)
+        specialty = None if specialty == 'All' else specialty
+        tags = tag_pick.multiselect('Tags', CASES.tags(), disabled=st.session_state.disabled)
+
     option = st.selectbox(
         "Which clinical scenario would you like to practice with?",
-        ("Select one", *list(CASES.keys())),
+        ("Select one", *CASES.search(query, specialty, tags)),
         disabled=st.session_state.disabled,
         on_change=disable,
+        key='option',
     )
 
-    while option == "Select one":
-        time.sleep(1)
+    # selecting -> running -> feedback, driven by disabled and feedback_state; nothing blocks while idle,
+    # the next widget event reruns the script
+    if option == "Select one":
+        st.stop()
 
-    prompt = create_prompt(CASES, option)
+    if 'exam' not in st.session_state:
+        # built once per session, so reruns don't recalibrate the microphone or rebuild the memory
+        st.session_state.exam = Exam(create_prompt(CASES, option), option, session_id=st.session_state.session_id,
+                                     user=st.query_params.get('user'))
+        st.query_params['session'] = st.session_state.session_id
 
     st.write(f'You selected: {option}')
-    patient = Exam(prompt, option)
-    patient.main()
+    st.session_state.exam.main()
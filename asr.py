@@ -0,0 +1,240 @@
+import io
+import os
+import queue
+import threading
+import time
+import wave
+from concurrent.futures import Future
+
+import numpy as np
+
+ASR_BACKEND = os.getenv("ASR_BACKEND", "whisper")
+ASR_THREADS = int(os.getenv("ASR_THREADS", "0"))  # CPU threads per engine, 0 for the library default
+WHISPER_MODEL = os.getenv("WHISPER_MODEL", "base")
+WHISPER_WORKERS = int(os.getenv("WHISPER_WORKERS", "1"))
+WHISPER_MAX_BATCH = int(os.getenv("WHISPER_MAX_BATCH", "8"))
+WHISPER_BATCH_DELAY = float(os.getenv("WHISPER_BATCH_DELAY", "0.05"))  # seconds
+
+N_SAMPLES = 30 * 16000  # whisper's 30 s window
+
+_ENGINES = {}
+_SERVICES = {}
+_ENGINES_LOCK = threading.Lock()
+
+
+def tensor_bytes(value):
+    # quantized linear layers keep their weights as a packed (weight, bias) tuple in the state dict
+    if isinstance(value, (tuple, list)):
+        return sum(tensor_bytes(v) for v in value)
+    return value.numel() * value.element_size() if hasattr(value, 'numel') else 0
+
+
+def model_bytes(model):
+    # sizes from the state dict without copying it; quantized weights are packed outside .parameters()
+    return sum(tensor_bytes(value) for value in model.state_dict().values())
+
+
+class WhisperEngine:
+    name = 'whisper'
+    quantize = False
+
+    def __init__(self, model_size=WHISPER_MODEL, threads=ASR_THREADS):
+        import torch
+        import whisper  # pulls in torch; only paid for once a case starts or warm-up runs
+
+        if threads:
+            torch.set_num_threads(threads)
+        self.model_size = model_size
+        start = time.perf_counter()
+        self.model = whisper.load_model(model_size, device="cpu")
+        if self.quantize:
+            # whisper's Linear subclass only adds an fp16 cast, which CPU inference never uses
+            for module in self.model.modules():
+                if isinstance(module, torch.nn.Linear):
+                    module.__class__ = torch.nn.Linear
+            self.model = torch.quantization.quantize_dynamic(self.model, {torch.nn.Linear}, dtype=torch.qint8)
+        self.load_time = time.perf_counter() - start
+        self.memory_bytes = model_bytes(self.model)
+        # whisper models are not safe to run from several threads at once
+        self.lock = threading.Lock()
+        print(f'{self.name} {model_size} loaded in {self.load_time:.2f}s ({self.memory_bytes / 2**20:.0f} MiB)')
+
+    def transcribe(self, audio):
+        with self.lock:
+            return self.model.transcribe(audio, language='en', fp16=False)['text']
+
+    def transcribe_batch(self, audios):
+        import torch
+        import whisper
+
+        # utterances that fit in one 30 s window share a single decoder pass
+        mel = torch.stack([
+            whisper.log_mel_spectrogram(whisper.pad_or_trim(audio), self.model.dims.n_mels)
+            for audio in audios
+        ]).to(self.model.device)
+        options = whisper.DecodingOptions(language='en', fp16=False, without_timestamps=True)
+        with self.lock:
+            results = whisper.decode(self.model, mel, options)
+        return [result.text for result in results]
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'model': self.model_size,
+            'load_time': self.load_time,
+            'memory_mb': self.memory_bytes / 2**20,
+        }
+
+
+class QuantizedWhisperEngine(WhisperEngine):
+    # the same PyTorch model with its linear layers dynamically quantized to int8
+    name = 'whisper-int8'
+    quantize = True
+
+
+class FasterWhisperEngine:
+    # CTranslate2 port of whisper with int8 weights; needs `pip install faster-whisper`
+    name = 'faster-whisper'
+
+    def __init__(self, model_size=WHISPER_MODEL, threads=ASR_THREADS, compute_type='int8'):
+        from faster_whisper import WhisperModel
+
+        self.model_size = model_size
+        start = time.perf_counter()
+        self.model = WhisperModel(model_size, device='cpu', compute_type=compute_type, cpu_threads=threads)
+        self.load_time = time.perf_counter() - start
+        self.lock = threading.Lock()
+        print(f'{self.name} {model_size} loaded in {self.load_time:.2f}s')
+
+    def transcribe(self, audio):
+        with self.lock:
+            segments, _ = self.model.transcribe(audio, language='en', beam_size=1)
+            return ''.join(segment.text for segment in segments)
+
+    def transcribe_batch(self, audios):
+        return [self.transcribe(audio) for audio in audios]
+
+    def stats(self):
+        return {
+            'backend': self.name,
+            'model': self.model_size,
+            'load_time': self.load_time,
+        }
+
+
+ENGINES = {engine.name: engine for engine in (WhisperEngine, QuantizedWhisperEngine, FasterWhisperEngine)}
+
+
+class TranscriptionService:
+
+    def __init__(self, engine=None, workers=WHISPER_WORKERS, max_batch_size=WHISPER_MAX_BATCH,
+                 max_batch_delay=WHISPER_BATCH_DELAY):
+        self.engine = engine or get_engine()
+        self.max_batch_size = max_batch_size
+        self.max_batch_delay = max_batch_delay
+        self.queue = queue.Queue()
+        self.batches = 0
+        self.requests = 0
+        self.threads = [threading.Thread(target=self._worker, daemon=True) for _ in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def submit(self, audio):
+        future = Future()
+        self.queue.put((audio, future))
+        return future
+
+    def _next_batch(self):
+        batch = [self.queue.get()]
+        deadline = time.perf_counter() + self.max_batch_delay
+        while len(batch) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0:
+                break
+            try:
+                batch.append(self.queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return batch
+
+    def _worker(self):
+        while True:
+            batch = [(audio, future) for audio, future in self._next_batch() if future.set_running_or_notify_cancel()]
+            short = [(audio, future) for audio, future in batch if len(audio) <= N_SAMPLES]
+            long = [(audio, future) for audio, future in batch if len(audio) > N_SAMPLES]
+            self.batches += 1
+            self.requests += len(batch)
+
+            if short:
+                try:
+                    texts = self.engine.transcribe_batch([audio for audio, _ in short])
+                except Exception as e:
+                    for _, future in short:
+                        future.set_exception(e)
+                else:
+                    for (_, future), text in zip(short, texts):
+                        future.set_result(text)
+
+            # anything longer than one window needs whisper's sliding-window transcribe
+            for audio, future in long:
+                try:
+                    future.set_result(self.engine.transcribe(audio))
+                except Exception as e:
+                    future.set_exception(e)
+
+
+def resample(audio, orig_sr, sr):
+    if orig_sr == sr or len(audio) == 0:
+        return audio
+    # band-limited FFT resampling; cheap at utterance lengths and free of aliasing
+    n = round(len(audio) * sr / orig_sr)
+    spectrum = np.fft.rfft(audio)
+    keep = min(len(spectrum), n // 2 + 1)
+    out = np.fft.irfft(spectrum[:keep], n)
+    out *= n / len(audio)
+    return out.astype(np.float32, copy=False)
+
+
+def decode_wav(data, sr=16000):
+    # speech_recognition already hands us PCM WAV, so skip ffmpeg and read the samples directly
+    try:
+        with wave.open(io.BytesIO(data)) as w:
+            width, channels, rate = w.getsampwidth(), w.getnchannels(), w.getframerate()
+            frames = w.readframes(w.getnframes())
+    except (wave.Error, EOFError) as e:
+        raise ValueError(f'not a PCM WAV file: {e}') from e
+    return pcm_to_float(frames, width, rate, channels, sr)
+
+
+def pcm_to_float(frames, width, rate, channels=1, sr=16000):
+    if width == 1:
+        audio = np.frombuffer(frames, np.uint8).astype(np.float32)
+        audio -= 128
+        audio /= 128
+    elif width in (2, 4):
+        audio = np.frombuffer(frames, f'<i{width}').astype(np.float32)
+        audio /= 2 ** (8 * width - 1)
+    else:
+        raise ValueError(f'unsupported sample width: {width}')
+
+    if channels > 1:
+        audio = audio.reshape(-1, channels).mean(axis=1, dtype=np.float32)
+    return resample(audio, rate, sr)
+
+
+def get_engine(model_size=WHISPER_MODEL, backend=ASR_BACKEND):
+    # one engine per backend and model size for the whole process, shared by every session
+    with _ENGINES_LOCK:
+        if (backend, model_size) not in _ENGINES:
+            if backend not in ENGINES:
+                raise ValueError(f'unknown ASR backend {backend!r}, expected one of {sorted(ENGINES)}')
+            _ENGINES[backend, model_size] = ENGINES[backend](model_size)
+        return _ENGINES[backend, model_size]
+
+
+def get_service(model_size=WHISPER_MODEL, backend=ASR_BACKEND):
+    engine = get_engine(model_size, backend)
+    with _ENGINES_LOCK:
+        if (backend, model_size) not in _SERVICES:
+            _SERVICES[backend, model_size] = TranscriptionService(engine)
+        return _SERVICES[backend, model_size]
@@ -0,0 +1,387 @@
+import argparse
+import glob
+import logging
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+SAMPLE_RATE = 16000
+SENTENCES = [
+    'The case is a previously healthy 26 year-old male who presents to the emergency room.',
+    'What is your differential diagnosis?',
+    'Can you elaborate on that?',
+    'How would you manage this patient in the first twenty-four hours?',
+    'Here is the CT scan of the head.',
+]
+SCRIPTED_ANSWERS = [
+    'I would start with the ABCs and a full neurological examination.',
+    'My differential includes an arteriovenous malformation, a cavernoma and a hypertensive hemorrhage.',
+    'I would order a CT angiogram and then a formal catheter angiogram.',
+    'I would offer surgical resection through a suboccipital craniotomy.',
+]
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+def load_fixtures(paths, n, seconds=5):
+    if paths:
+        import whisper
+        audios = [whisper.load_audio(path) for path in paths]
+    else:
+        # no recordings given: a quiet tone keeps the decoder short and repeatable
+        t = np.arange(int(seconds * SAMPLE_RATE)) / SAMPLE_RATE
+        audios = [(0.05 * np.sin(2 * np.pi * 220 * t)).astype(np.float32)]
+    return [audios[i % len(audios)] for i in range(n)]
+
+
+def report(name, n, elapsed):
+    print(f'{name:<12} {n} utterances in {elapsed:.2f}s  ({n / elapsed:.2f} utt/s, {1000 * elapsed / n:.0f} ms/utt)')
+
+
+def bench_transcription(args):
+    import asr
+
+    engine = asr.get_engine(args.model)
+    audios = load_fixtures(args.audio, args.n)
+    engine.transcribe(audios[0])  # warm-up
+
+    # today's path: every session transcribes on its own thread, one at a time through the model
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.sessions) as pool:
+        list(pool.map(engine.transcribe, audios))
+    report('sequential', len(audios), time.perf_counter() - start)
+
+    service = asr.TranscriptionService(engine, workers=args.workers, max_batch_size=args.batch_size,
+                                       max_batch_delay=args.delay)
+    start = time.perf_counter()
+    with ThreadPoolExecutor(args.sessions) as pool:
+        list(pool.map(lambda audio: service.submit(audio).result(), audios))
+    report('batched', len(audios), time.perf_counter() - start)
+    print(f'{service.batches} batches, {service.requests / max(service.batches, 1):.1f} utterances per batch')
+
+
+def normalize(text):
+    return re.sub(r"[^a-z0-9' ]+", ' ', text.lower().replace('-', ' ')).split()
+
+
+def word_errors(reference, hypothesis):
+    # word-level Levenshtein distance
+    ref, hyp = normalize(reference), normalize(hypothesis)
+    row = list(range(len(hyp) + 1))
+    for i, r in enumerate(ref, 1):
+        prev, row[0] = row[0], i
+        for j, h in enumerate(hyp, 1):
+            prev, row[j] = row[j], min(row[j] + 1, row[j - 1] + 1, prev + (r != h))
+    return row[-1], len(ref)
+
+
+def load_references(paths):
+    # answerN.wav are the synthesized SCRIPTED_ANSWERS; any other recording needs a .txt transcript next to it
+    references = []
+    for path in paths:
+        sidecar = os.path.splitext(path)[0] + '.txt'
+        if os.path.exists(sidecar):
+            with open(sidecar) as f:
+                references.append(f.read().strip())
+        else:
+            match = re.fullmatch(r'answer(\d+)\.wav', os.path.basename(path))
+            if not match:
+                raise ValueError(f'no reference transcript for {path} (expected {sidecar})')
+            references.append(SCRIPTED_ANSWERS[int(match.group(1)) - 1])
+    return references
+
+
+def bench_asr(args):
+    import asr
+
+    paths = sorted(glob.glob(os.path.join(args.fixtures, '*.wav'))) or make_fixtures(args.fixtures, args.fixture_tts)
+    references = load_references(paths)
+    audios = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            audios.append(asr.decode_wav(f.read(), SAMPLE_RATE))
+    audio_seconds = sum(len(audio) for audio in audios) / SAMPLE_RATE
+
+    print(f'{len(paths)} fixtures, {audio_seconds:.1f}s of audio, {args.threads or "default"} threads')
+    for backend in args.backend:
+        for model in args.model:
+            try:
+                engine = asr.ENGINES[backend](model, threads=args.threads)
+            except ImportError as e:
+                print(f'{backend:<15} {model:<8} skipped: {e}')
+                continue
+            engine.transcribe(audios[0])  # warm-up
+            errors = words = 0
+            start = time.perf_counter()
+            for audio, reference in zip(audios, references):
+                e, n = word_errors(reference, engine.transcribe(audio))
+                errors += e
+                words += n
+            elapsed = time.perf_counter() - start
+            memory = engine.stats().get('memory_mb')
+            print(f'{backend:<15} {model:<8} WER {100 * errors / words:5.1f}%  '
+                  f'real-time factor {elapsed / audio_seconds:.3f}  load {engine.stats()["load_time"]:.1f}s'
+                  + (f'  {memory:.0f} MiB' if memory else ''))
+
+
+def bench_tts(args):
+    import tts
+
+    for name in args.backend:
+        backend = tts.get_backend(name)
+        tts.synthesize(SENTENCES[0], backend=backend, cache=False)  # warm-up
+        latencies, rtfs = [], []
+        for i in range(args.n):
+            sentence = SENTENCES[i % len(SENTENCES)]
+            start = time.perf_counter()
+            segment = tts.synthesize(sentence, backend=backend, cache=False)
+            elapsed = time.perf_counter() - start
+            latencies.append(elapsed)
+            rtfs.append(elapsed / segment.duration_seconds)
+        print(f'{name:<8} latency p50 {1000 * np.percentile(latencies, 50):.0f} ms  '
+              f'p95 {1000 * np.percentile(latencies, 95):.0f} ms  real-time factor {np.mean(rtfs):.3f}')
+
+
+def bench_memory(args):
+    from transformers import GPT2TokenizerFast
+    from memory import TokenBuffer
+
+    tokenizer = GPT2TokenizerFast.from_pretrained('gpt2')
+    count = lambda text: len(tokenizer(text)['input_ids'])
+    turns = [f'{"Me" if i % 2 else "Examiner"}: {SENTENCES[i % len(SENTENCES)] * (1 + i % 4)}' for i in range(args.turns)]
+
+    # old update_session_history: re-tokenize the whole joined history on every append
+    start = time.perf_counter()
+    history = []
+    for turn in turns:
+        history.append(turn)
+        while count('\n'.join(history)) > args.max_tokens:
+            history.pop(0)
+    rejoin = time.perf_counter() - start
+
+    start = time.perf_counter()
+    buffer = TokenBuffer(args.max_tokens, count)
+    for turn in turns:
+        buffer.append(turn)
+    cached = time.perf_counter() - start
+
+    print(f'{args.turns} turns, {args.max_tokens} token cap')
+    print(f're-tokenize history  {1000 * rejoin:.1f} ms  ({1e6 * rejoin / args.turns:.0f} us/turn)')
+    print(f'TokenBuffer          {1000 * cached:.1f} ms  ({1e6 * cached / args.turns:.0f} us/turn)')
+
+
+def import_profile():
+    # python -X importtime lines look like "import time:   self [us] | cumulative | package"
+    start = time.perf_counter()
+    proc = subprocess.run([sys.executable, '-X', 'importtime', '-c', 'import app'], cwd=HERE,
+                          capture_output=True, text=True)
+    elapsed = time.perf_counter() - start
+    if proc.returncode != 0:
+        raise RuntimeError(f'importing app.py failed:\n{proc.stderr[-2000:]}')
+    modules = []
+    for line in proc.stderr.splitlines():
+        if not line.startswith('import time:') or 'cumulative' in line:
+            continue
+        _, cumulative, name = line[len('import time:'):].split('|')
+        depth = (len(name) - len(name.lstrip()) - 1) // 2
+        if depth <= 1:  # app itself and what it imports directly
+            modules.append((int(cumulative) / 1e6, name.strip()))
+    return elapsed, sorted(modules, reverse=True)
+
+
+def bench_startup(args):
+    runs = [import_profile() for _ in range(args.n)]
+    elapsed = statistics.median(wall for wall, _ in runs)
+
+    print(f'slowest imports of app.py (last of {args.n} runs):')
+    for seconds, name in runs[-1][1][:args.top]:
+        print(f'  {1000 * seconds:8.1f} ms  {name}')
+    print(f'median interpreter start + import app: {1000 * elapsed:.0f} ms')
+    if args.budget and elapsed > args.budget:
+        print(f'startup regression: {elapsed:.2f}s is over the {args.budget:.2f}s budget')
+        sys.exit(1)
+
+
+def make_fixtures(directory, backend):
+    # synthesize the scripted answers once so there is real speech to transcribe on a box without a microphone
+    import wave
+    import tts
+
+    os.makedirs(directory, exist_ok=True)
+    paths = []
+    for i, text in enumerate(SCRIPTED_ANSWERS):
+        path = os.path.join(directory, f'answer{i + 1}.wav')
+        if not os.path.exists(path):
+            segment = tts.get_backend(backend).synthesize(text).set_frame_rate(SAMPLE_RATE).set_channels(1).set_sample_width(2)
+            with wave.open(path, 'wb') as w:
+                w.setnchannels(1)
+                w.setsampwidth(2)
+                w.setframerate(SAMPLE_RATE)
+                w.writeframes(segment.raw_data)
+        paths.append(path)
+    return paths
+
+
+def setup_replay(args):
+    # these modules read their settings on import
+    os.environ['LLM_BACKEND'] = args.llm
+    os.environ['TTS_BACKEND'] = args.tts
+    os.environ['TRACE_FILE'] = args.trace_file
+    os.chdir(HERE)
+    import app
+
+    for name in list(logging.root.manager.loggerDict):
+        if name.startswith('streamlit'):
+            logging.getLogger(name).setLevel(logging.ERROR)  # bare-mode warnings from every st.* call
+
+    fixtures = sorted(glob.glob(os.path.join(args.fixtures, '*.wav'))) or make_fixtures(args.fixtures, args.fixture_tts)
+    app.warm_up().join()
+    return app, fixtures[:args.turns]
+
+
+def replay_sessions(app, fixtures, sessions, concurrency, realtime=False):
+    import capture
+    from memory import TokenBuffer, count_tokens
+
+    def run_session(case, i):
+        exam = app.Exam(app.create_prompt(app.CASES, case), case, session_id=f'bench-{case}-{i}', headless=True,
+                        session_history=TokenBuffer(8000, count_tokens))
+        exam.run(capture.FixtureSource(fixtures, realtime=realtime))
+        return exam
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(concurrency) as pool:
+        exams = list(pool.map(lambda session: run_session(*session), sessions))
+    return exams, time.perf_counter() - start
+
+
+def peak_rss():
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def bench_replay(args):
+    import tracing
+
+    app, fixtures = setup_replay(args)
+    sessions = [(case, i) for case in app.CASES for i in range(args.sessions)]
+    exams, elapsed = replay_sessions(app, fixtures, sessions, args.concurrency, args.realtime)
+
+    turns = sum(len(exam.metrics) for exam in exams)
+    print(f'{len(sessions)} sessions over {len(app.CASES)} cases, {turns} turns in {elapsed:.2f}s '
+          f'({turns / elapsed:.2f} turns/s, concurrency {args.concurrency})')
+    sink = tracing.get_sink()
+    with sink.lock:
+        stages = {stage: list(durations) for stage, durations in sink.durations.items()}
+    for stage, durations in sorted(stages.items()):
+        print(f'  {stage:<20} p50 {1000 * np.percentile(durations, 50):8.1f} ms  '
+              f'p95 {1000 * np.percentile(durations, 95):8.1f} ms  (n={len(durations)})')
+    speculators = [exam.speculator for exam in exams if exam.speculator]
+    if speculators:
+        hits = sum(s.hits for s in speculators)
+        taken = hits + sum(s.misses for s in speculators)
+        print(f'speculation: {sum(s.drafts for s in speculators)} drafts, hit rate {hits / max(taken, 1):.0%}, '
+              f'{sum(s.saved_seconds for s in speculators):.1f}s of generation overlapped with speech')
+    print(f'peak RSS {peak_rss():.0f} MiB')
+
+
+def bench_sessions(args):
+    import threading
+    from streamlit.testing.v1 import AppTest
+
+    app, fixtures = setup_replay(args)
+
+    # idle tabs: each one runs the script up to the case picker and must return without holding a thread
+    threads = threading.active_count()
+    tabs = []
+    start = time.perf_counter()
+    for _ in range(args.idle):
+        tab = AppTest.from_file(os.path.join(HERE, 'app.py'), default_timeout=args.timeout)
+        tab.run()
+        if tab.exception:
+            raise RuntimeError(f'app.py failed: {tab.exception[0].message}')
+        tabs.append(tab)
+    elapsed = time.perf_counter() - start
+    print(f'{args.idle} idle sessions opened in {elapsed:.2f}s ({1000 * elapsed / args.idle:.0f} ms each), '
+          f'{threading.active_count() - threads} extra threads, peak RSS {peak_rss():.0f} MiB')
+
+    # active sessions: scripted exams all talking at once
+    case = next(iter(app.CASES))
+    for n in args.active:
+        exams, elapsed = replay_sessions(app, fixtures, [(case, i) for i in range(n)], n, args.realtime)
+        turns = [turn['seconds'] for exam in exams for turn in exam.metrics]
+        print(f'{n:>4} active sessions  {len(turns) / elapsed:7.2f} turns/s  '
+              f'turn p50 {1000 * np.percentile(turns, 50):8.1f} ms  p95 {1000 * np.percentile(turns, 95):8.1f} ms  '
+              f'peak RSS {peak_rss():.0f} MiB')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Performance benchmarks for the oral exam app.')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+
+    p = subparsers.add_parser('transcription', help='one-at-a-time vs batched Whisper transcription')
+    p.add_argument('--model', default='base')
+    p.add_argument('--audio', nargs='*', help='audio files to replay (default: synthetic tone)')
+    p.add_argument('-n', type=int, default=32, help='number of utterances')
+    p.add_argument('--sessions', type=int, default=8, help='concurrent sessions submitting audio')
+    p.add_argument('--workers', type=int, default=1)
+    p.add_argument('--batch-size', type=int, default=8)
+    p.add_argument('--delay', type=float, default=0.05, help='maximum batch delay in seconds')
+    p.set_defaults(func=bench_transcription)
+
+    p = subparsers.add_parser('asr', help='word error rate and real-time factor of each ASR backend and model size')
+    p.add_argument('--backend', nargs='+', default=['whisper', 'whisper-int8', 'faster-whisper'])
+    p.add_argument('--model', nargs='+', default=['tiny', 'base', 'small'])
+    p.add_argument('--threads', type=int, default=0, help='CPU threads per engine (0 for the library default)')
+    p.add_argument('--fixtures', default=os.path.join(HERE, 'fixtures'), help='directory of answer WAV files')
+    p.add_argument('--fixture-tts', default='gtts', help='TTS backend used to create missing fixtures')
+    p.set_defaults(func=bench_asr)
+
+    p = subparsers.add_parser('tts', help='latency and real-time factor of each speech synthesis backend')
+    p.add_argument('--backend', nargs='+', default=['gtts', 'pyttsx3'])
+    p.add_argument('-n', type=int, default=20, help='sentences per backend')
+    p.set_defaults(func=bench_tts)
+
+    p = subparsers.add_parser('memory', help='token accounting cost over long sessions')
+    p.add_argument('--turns', type=int, default=1000)
+    p.add_argument('--max-tokens', type=int, default=8000)
+    p.set_defaults(func=bench_memory)
+
+    p = subparsers.add_parser('startup', help='import-time profile of app.py and startup regression check')
+    p.add_argument('-n', type=int, default=5, help='fresh interpreters to time')
+    p.add_argument('--top', type=int, default=15)
+    p.add_argument('--budget', type=float, default=2.0, help='fail if median startup exceeds this many seconds')
+    p.set_defaults(func=bench_startup)
+
+    p = subparsers.add_parser('replay', help='replay scripted sessions for every case headlessly')
+    p.add_argument('--fixtures', default=os.path.join(HERE, 'fixtures'), help='directory of answer WAV files')
+    p.add_argument('--fixture-tts', default='gtts', help='TTS backend used to create missing fixtures')
+    p.add_argument('--sessions', type=int, default=4, help='sessions per case')
+    p.add_argument('--turns', type=int, default=4, help='answers per session')
+    p.add_argument('--concurrency', type=int, default=4)
+    p.add_argument('--llm', default='local', help='LLM backend (local or openai)')
+    p.add_argument('--tts', default='silent', help='TTS backend for the examiner')
+    p.add_argument('--realtime', action='store_true', help='feed fixture audio at real-time speed')
+    p.add_argument('--trace-file', default='', help='also write spans to this JSONL file')
+    p.set_defaults(func=bench_replay)
+
+    p = subparsers.add_parser('sessions', help='how many idle and active sessions one process holds')
+    p.add_argument('--idle', type=int, default=50, help='idle sessions sitting at the case picker')
+    p.add_argument('--active', type=int, nargs='+', default=[1, 4, 16], help='concurrent active sessions to try')
+    p.add_argument('--timeout', type=float, default=30, help='seconds an idle session may take to render')
+    p.add_argument('--fixtures', default=os.path.join(HERE, 'fixtures'), help='directory of answer WAV files')
+    p.add_argument('--fixture-tts', default='gtts', help='TTS backend used to create missing fixtures')
+    p.add_argument('--turns', type=int, default=4, help='answers per session')
+    p.add_argument('--llm', default='local', help='LLM backend (local or openai)')
+    p.add_argument('--tts', default='silent', help='TTS backend for the examiner')
+    p.add_argument('--realtime', action='store_true', help='feed fixture audio at real-time speed')
+    p.add_argument('--trace-file', default='', help='also write spans to this JSONL file')
+    p.set_defaults(func=bench_sessions)
+
+    args = parser.parse_args()
+    args.func(args)
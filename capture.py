@@ -0,0 +1,187 @@
+import os
+import threading
+import time
+from collections import deque
+
+import numpy as np
+
+import asr
+
+END_SILENCE = float(os.getenv("END_SILENCE", "0.4"))  # seconds of silence that end an answer
+SEGMENT_SILENCE = float(os.getenv("SEGMENT_SILENCE", "0.25"))  # shorter pauses split the answer into chunks
+CALIBRATION_SECONDS = float(os.getenv("CALIBRATION_SECONDS", "0.5"))  # leading silence used to measure the room
+
+_PROFILES = {}
+_PROFILES_LOCK = threading.Lock()
+
+
+class NoiseProfile:
+    # the microphone's energy threshold, measured from the first frames of the first answer and then tracked
+    # from the silence before every answer, instead of a blocking calibration for each new exam
+
+    def __init__(self, threshold=300, calibrated=False, calibration_seconds=CALIBRATION_SECONDS, ratio=1.5,
+                 damping=0.15, min_threshold=100, percentile=10):
+        self.threshold = threshold
+        self.calibrated = calibrated
+        self.calibration_seconds = calibration_seconds
+        self.ratio = ratio
+        self.percentile = percentile
+        self.damping = damping
+        self.min_threshold = min_threshold
+        self.energies = []
+        self.seconds = 0.0
+
+    def measure(self, energy, seconds):
+        # called with every frame, speech included, until calibrated. The noise floor is a low percentile of
+        # their energies, so a resident who starts talking straight away doesn't set the threshold from their voice
+        self.energies.append(energy)
+        self.seconds += seconds
+        if self.seconds >= self.calibration_seconds:
+            noise = float(np.percentile(self.energies, self.percentile))
+            self.threshold = max(self.min_threshold, noise * self.ratio)
+            self.calibrated = True
+            self.energies = []
+
+    def observe(self, energy, seconds):
+        # called with every frame heard before speech starts, once calibrated;
+        # same damped update speech_recognition applies while it waits for speech
+        damping = self.damping ** seconds
+        self.threshold = max(self.min_threshold, self.threshold * damping + energy * self.ratio * (1 - damping))
+
+
+def get_noise_profile(device=None):
+    # one profile per input device, shared by every session and kept across reruns
+    with _PROFILES_LOCK:
+        if device not in _PROFILES:
+            _PROFILES[device] = NoiseProfile()
+        return _PROFILES[device]
+
+
+class StreamingCapture:
+
+    def __init__(self, recognizer, transcriber, noise=None, end_silence=END_SILENCE, segment_silence=SEGMENT_SILENCE,
+                 preroll=0.3, min_segment=1.0, max_segment=25.0, partial_every=1.0):
+        self.r = recognizer
+        self.transcriber = transcriber
+        self.noise = noise or NoiseProfile(recognizer.energy_threshold, calibrated=True)
+        self.end_silence = end_silence
+        self.segment_silence = segment_silence
+        self.preroll = preroll
+        self.min_segment = min_segment
+        self.max_segment = max_segment
+        self.partial_every = partial_every
+        self.speech_end = None  # perf_counter at end of speech for the last answer
+        self.audio_seconds = 0.0
+
+    def energy(self, frame, width):
+        # same energy measure speech_recognition uses, so its thresholds still apply
+        samples = np.frombuffer(frame, f'<i{width}').astype(np.float32)
+        return float(np.sqrt(np.mean(samples * samples)))
+
+    def listen(self, source, on_partial=None):
+        width, rate = source.SAMPLE_WIDTH, source.SAMPLE_RATE
+        bytes_per_second = width * rate
+        frame_seconds = source.CHUNK / rate
+
+        def submit(pcm):
+            return self.transcriber.submit(asr.pcm_to_float(bytes(pcm), width, rate))
+
+        preroll = deque(maxlen=max(1, int(self.preroll / frame_seconds)))
+        segments = []  # (future, last partial text) for the chunks already sent to whisper
+        current = bytearray()
+        committed = 0
+        speaking = False
+        silence = 0.0
+        partial, partial_at, partial_text, shown = None, 0, '', ''
+
+        while True:
+            frame = source.stream.read(source.CHUNK)
+            energy = self.energy(frame, width)
+            # the default threshold detects speech until the profile is calibrated
+            voiced = energy > self.noise.threshold
+            if not self.noise.calibrated:
+                self.noise.measure(energy, frame_seconds)
+            elif not speaking and not voiced:
+                self.noise.observe(energy, frame_seconds)
+            if not speaking:
+                if not voiced:
+                    preroll.append(frame)
+                    continue
+                speaking = True
+                current.extend(b''.join(preroll))
+            current.extend(frame)
+            silence = 0.0 if voiced else silence + frame_seconds
+            seconds = len(current) / bytes_per_second
+
+            if silence >= self.end_silence:
+                break
+
+            # close the chunk at a short pause (or before it outgrows whisper's window) and start decoding it
+            if (silence >= self.segment_silence and seconds >= self.min_segment) or seconds >= self.max_segment:
+                segments.append((submit(current), partial_text))
+                committed += len(current)
+                current = bytearray()
+                partial, partial_at, partial_text = None, 0, ''
+                continue
+
+            if on_partial is None:
+                continue
+            if partial is not None and partial.done():
+                partial_text = partial_text if partial.exception() else partial.result().strip()
+                partial = None
+            if partial is None and len(current) - partial_at >= self.partial_every * bytes_per_second:
+                partial, partial_at = submit(current), len(current)
+            text = ' '.join([self._text(f, placeholder) for f, placeholder in segments] + [partial_text]).strip()
+            if text != shown:
+                on_partial(text)
+                shown = text
+
+        self.speech_end = time.perf_counter()
+        self.audio_seconds = (committed + len(current)) / bytes_per_second
+
+        # only the tail after the last pause is still undecoded at end of speech
+        if silence < len(current) / bytes_per_second:
+            segments.append((submit(current), partial_text))
+        try:
+            return ' '.join(f.result().strip() for f, _ in segments).strip() or None
+        except Exception:
+            return None
+
+    def _text(self, future, placeholder):
+        if future.done() and not future.exception():
+            return future.result().strip()
+        return placeholder
+
+
+class FixtureSource:
+    # stands in for sr.Microphone in headless mode: feeds recorded WAV answers to the capture loop,
+    # each followed by silence so end of speech is detected, and raises EOFError once they run out
+    SAMPLE_WIDTH = 2
+    SAMPLE_RATE = 16000
+    CHUNK = 1024
+
+    def __init__(self, paths, silence=1.5, realtime=False):
+        self.answers = deque(paths)
+        self.silence = bytes(int(silence * self.SAMPLE_RATE) * self.SAMPLE_WIDTH)
+        self.realtime = realtime
+        self.buffer = b''
+        self.stream = self
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def read(self, frames):
+        size = frames * self.SAMPLE_WIDTH
+        while len(self.buffer) < size:
+            if not self.answers:
+                raise EOFError('no more recorded answers')
+            with open(self.answers.popleft(), 'rb') as f:
+                audio = asr.decode_wav(f.read(), self.SAMPLE_RATE)
+            self.buffer += (np.clip(audio, -1, 1) * 32767).astype('<i2').tobytes() + self.silence
+        frame, self.buffer = self.buffer[:size], self.buffer[size:]
+        if self.realtime:
+            time.sleep(frames / self.SAMPLE_RATE)
+        return frame
@@ -0,0 +1,275 @@
+import glob
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import sys
+import threading
+import time
+
+CASES_FILE = os.getenv("CASES_FILE", "cases.json")
+CASES_DIR = os.getenv("CASES_DIR", "cases")  # one <name>.json per case, same schema as cases.json
+CASE_PACK_DIR = os.getenv("CASE_PACK_DIR", ".case_pack")
+IMAGE_WIDTH = int(os.getenv("IMAGE_WIDTH", "800"))  # renditions are shown at 400px, so 2x for high-dpi screens
+CASE_RELOAD_INTERVAL = float(os.getenv("CASE_RELOAD_INTERVAL", "2"))  # seconds between checks for edited case files
+CASE_CACHE_SIZE = int(os.getenv("CASE_CACHE_SIZE", "64"))  # compiled cases kept in memory
+
+INSTRUCTIONS = "Instructions: You are an evaluator for a neurosurgery oral exam. Provide contextual information to the examinee as relevant, as the examinee does not have any information of the case beforehand. Speak as if you were talking the examinee. Treat this as an exam and do not provide words of encouragement. Provide hints if the examinee does not know the answer.\n\nContext:{case_info}\nPlease write the image files in parentheses if you would like to use them in your questions. You do not need to use these images in the first question unless relevant. If you've already used an image, no need to include it in parentheses."
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER);
+CREATE TABLE IF NOT EXISTS cases (
+    name TEXT PRIMARY KEY, source TEXT, hash TEXT, specialty TEXT, tags TEXT,
+    prompt TEXT, prompt_tokens INTEGER, images TEXT
+);
+CREATE INDEX IF NOT EXISTS cases_specialty ON cases (specialty);
+CREATE INDEX IF NOT EXISTS cases_source ON cases (source);
+'''
+
+_PACK = None
+_PACK_LOCK = threading.Lock()
+
+
+class Case:
+
+    def __init__(self, name, prompt, prompt_tokens, images, specialty='', tags=(), on_count=None):
+        self.name = name
+        self.prompt = prompt
+        self._prompt_tokens = prompt_tokens
+        self.on_count = on_count
+        self.images = images  # image reference as written in the case file -> web-sized rendition
+        self.specialty = specialty
+        self.tags = list(tags)
+        # longest first, so a reference that is a prefix of another never shadows it
+        refs = sorted(images, key=len, reverse=True)
+        self.matcher = re.compile('|'.join(map(re.escape, refs))) if refs else None
+
+    @property
+    def prompt_tokens(self):
+        # counted when an exam first needs it, not when the pack is built, so indexing never loads the tokenizer
+        if self._prompt_tokens is None:
+            from memory import count_tokens
+            self._prompt_tokens = count_tokens(self.prompt)
+            if self.on_count:
+                self.on_count(self)
+        return self._prompt_tokens
+
+    def image_refs(self, text):
+        if self.matcher is None:
+            return []
+        return list(dict.fromkeys(self.matcher.findall(text)))
+
+
+class CasePack:
+    # an SQLite index over the case files: only names, specialties and tags are held in memory, a case's
+    # prompt and images are read when it is first used, and edited files are recompiled case by case
+
+    def __init__(self, out_dir=CASE_PACK_DIR, source=CASES_FILE, cases_dir=CASES_DIR,
+                 reload_interval=CASE_RELOAD_INTERVAL, cache_size=CASE_CACHE_SIZE):
+        os.makedirs(out_dir, exist_ok=True)
+        self.out_dir = out_dir
+        self.source = source
+        self.cases_dir = cases_dir
+        self.reload_interval = reload_interval
+        self.cache_size = cache_size
+        self.db = sqlite3.connect(os.path.join(out_dir, 'index.sqlite'), check_same_thread=False)
+        self.db.executescript(SCHEMA)
+        self.lock = threading.RLock()
+        self.listing = {}  # name -> (specialty, tags)
+        self.cache = {}
+        self.checked = 0
+        self.errors = []
+        self.refresh(force=True)
+
+    def sources(self):
+        paths = sorted(glob.glob(os.path.join(self.cases_dir, '*.json'))) if self.cases_dir else []
+        if self.source and os.path.exists(self.source):
+            paths.append(self.source)
+        return paths
+
+    def refresh(self, force=False):
+        # cheap when nothing changed: one stat per case file, at most every reload_interval seconds
+        with self.lock:
+            if not force and time.monotonic() - self.checked < self.reload_interval:
+                return []
+            self.checked = time.monotonic()
+            self.errors = []
+            known = {path: (mtime, size) for path, mtime, size in self.db.execute('SELECT * FROM sources')}
+            paths = self.sources()
+            changed = []
+            for path in paths:
+                stat = os.stat(path)
+                if known.get(path) != (stat.st_mtime, stat.st_size):
+                    changed += self._reindex(path, stat)
+            for path in set(known) - set(paths):
+                changed += [name for name, in self.db.execute('SELECT name FROM cases WHERE source = ?', (path,))]
+                self.db.execute('DELETE FROM cases WHERE source = ?', (path,))
+                self.db.execute('DELETE FROM sources WHERE path = ?', (path,))
+            self.db.commit()
+            for name in changed:
+                self.cache.pop(name, None)
+            if changed or not self.listing:
+                self.listing = {name: (specialty, json.loads(tags)) for name, specialty, tags in
+                                self.db.execute('SELECT name, specialty, tags FROM cases ORDER BY name')}
+            return changed
+
+    def rescan(self):
+        # re-read every case file, e.g. to report cases that failed validation earlier
+        with self.lock:
+            self.db.execute('DELETE FROM sources')
+            return self.refresh(force=True)
+
+    def _reindex(self, path, stat):
+        try:
+            with open(path) as f:
+                raw = json.load(f)
+            if not isinstance(raw, dict):
+                raise ValueError(f'expected an object of cases, got {type(raw).__name__}')
+        except (OSError, ValueError) as e:
+            self.errors.append(f'{path}: {e}')
+            print(f'could not read case file {path}: {e}')
+            # the file's cases stay as they were; don't re-read it until it changes again
+            self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (path, stat.st_mtime, stat.st_size))
+            return []
+        hashes = dict(self.db.execute('SELECT name, hash FROM cases WHERE source = ?', (path,)).fetchall())
+        changed, seen = [], set()
+        for name, entries in raw.items():
+            name = name.strip().lower()
+            seen.add(name)
+            try:
+                case = entries[0]
+                digest = hashlib.sha1(json.dumps([case, IMAGE_WIDTH], sort_keys=True).encode()).hexdigest()
+                if hashes.get(name) == digest:
+                    continue
+                row = compile_case(name, case, os.path.join(self.out_dir, 'images'))
+            except Exception as e:
+                # keep serving the last good version until the file is fixed
+                error = str(e) if isinstance(e, ValueError) else f'case {name!r} in {path} is malformed: {e!r}'
+                self.errors.append(error)
+                print(error)
+                continue
+            self.db.execute('INSERT OR REPLACE INTO cases VALUES (?, ?, ?, ?, ?, ?, ?, ?)', (name, path, digest, *row))
+            changed.append(name)
+        for name in set(hashes) - seen:
+            self.db.execute('DELETE FROM cases WHERE name = ?', (name,))
+            changed.append(name)
+        self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (path, stat.st_mtime, stat.st_size))
+        return changed
+
+    def __getitem__(self, name):
+        name = name.strip().lower()
+        with self.lock:
+            if name not in self.cache:
+                row = self.db.execute('SELECT specialty, tags, prompt, prompt_tokens, images FROM cases WHERE name = ?',
+                                      (name,)).fetchone()
+                if row is None:
+                    raise KeyError(name)
+                specialty, tags, prompt, prompt_tokens, images = row
+                if len(self.cache) >= self.cache_size:
+                    self.cache.pop(next(iter(self.cache)))
+                self.cache[name] = Case(name, prompt, prompt_tokens, json.loads(images), specialty, json.loads(tags),
+                                        on_count=self._save_tokens)
+            return self.cache[name]
+
+    def _save_tokens(self, case):
+        # the prompt may have been recompiled since the case was loaded
+        with self.lock:
+            self.db.execute('UPDATE cases SET prompt_tokens = ? WHERE name = ? AND prompt = ?',
+                            (case.prompt_tokens, case.name, case.prompt))
+            self.db.commit()
+
+    def __contains__(self, name):
+        return name.strip().lower() in self.listing
+
+    def __iter__(self):
+        return iter(list(self.listing))
+
+    def __len__(self):
+        return len(self.listing)
+
+    def keys(self):
+        return list(self.listing)
+
+    def specialties(self):
+        return sorted({specialty for specialty, _ in self.listing.values() if specialty})
+
+    def tags(self):
+        return sorted({tag for _, tags in self.listing.values() for tag in tags})
+
+    def search(self, query='', specialty=None, tags=()):
+        words = query.lower().split()
+        found = []
+        for name, (case_specialty, case_tags) in self.listing.items():
+            if specialty and case_specialty != specialty:
+                continue
+            if not set(tags) <= set(case_tags):
+                continue
+            text = ' '.join([name, case_specialty, *case_tags]).lower()
+            if all(word in text for word in words):
+                found.append(name)
+        return found
+
+
+def build_prompt(case):
+    prompt = INSTRUCTIONS.format(case_info=case['case_info'])
+    images, descriptions = case.get('images', []), case.get('img_descriptions', [])
+    if images:
+        prompt += '\n\nImages:\n' + ''.join(f'{image}: {description}\n'
+                                           for image, description in zip(images, descriptions))
+    return prompt
+
+
+def validate(name, case):
+    if not isinstance(case.get('case_info'), str) or not case['case_info'].strip():
+        raise ValueError(f'case {name!r} has no case_info')
+    images, descriptions = case.get('images', []), case.get('img_descriptions', [])
+    if len(images) != len(descriptions):
+        raise ValueError(f'case {name!r} has {len(images)} images but {len(descriptions)} img_descriptions')
+    for image in images:
+        if not os.path.isfile(image):
+            raise ValueError(f'case {name!r} refers to missing image {image}')
+    if not isinstance(case.get('tags', []), list):
+        raise ValueError(f'case {name!r} tags must be a list')
+
+
+def render_image(path, out_dir, width=IMAGE_WIDTH):
+    from PIL import Image
+
+    with open(path, 'rb') as f:
+        digest = hashlib.sha1(f.read()).hexdigest()[:16]
+    out = os.path.join(out_dir, f'{digest}-{width}.png')
+    if not os.path.exists(out):
+        with Image.open(path) as img:
+            if img.width > width:
+                img = img.resize((width, round(img.height * width / img.width)), Image.LANCZOS)
+            img.save(out, optimize=True)
+    return out
+
+
+def compile_case(name, case, image_dir, width=IMAGE_WIDTH):
+    validate(name, case)
+    os.makedirs(image_dir, exist_ok=True)
+    prompt = build_prompt(case)
+    images = {image: render_image(image, image_dir, width) for image in case.get('images', [])}
+    tags = [tag.strip().lower() for tag in case.get('tags', [])]
+    return case.get('specialty', '').strip().lower(), json.dumps(tags), prompt, None, json.dumps(images)
+
+
+def get_pack():
+    global _PACK
+    with _PACK_LOCK:
+        if _PACK is None:
+            _PACK = CasePack()
+        else:
+            _PACK.refresh()
+        return _PACK
+
+
+if __name__ == '__main__':
+    pack = CasePack()
+    pack.rescan()
+    for error in pack.errors:
+        print(f'error: {error}', file=sys.stderr)
+    print(f'{len(pack)} cases indexed in {CASE_PACK_DIR}')
+    sys.exit(1 if pack.errors else 0)
@@ -0,0 +1,40 @@
+from concurrent.futures import Future
+
+FEEDBACK_PROMPT = 'Based on the chat dialogue between me and the patient, please provide constructive feedback and criticism for the resident ("Me:"), NOT the examiner. Comment on the medical accuracy of responses. Comment on things that were done well, areas for improvement, and other remarks as necessary. Do not make anything up. If the examinee asks a question or requests more information, fulfill their request. Regardless of your initial response, ask the examinee about the case or ask follow-up questions.'
+ASSESS_PROMPT = 'Below is one exchange from a neurosurgery oral exam. Assess only the resident ("Me:"), NOT the examiner, in at most three short bullet points: medical accuracy, what was done well, and what could be improved. Do not make anything up.'
+SYNTHESIS_PROMPT = 'Below are notes assessing each of the resident\'s answers in a neurosurgery oral exam, in order. Based on them, please provide constructive feedback and criticism for the resident. Comment on the medical accuracy of responses. Comment on things that were done well, areas for improvement, and other remarks as necessary. Do not make anything up.'
+
+
+class RollingFeedback:
+    # assesses each answer in the background as the exam goes, so the final feedback is one short
+    # synthesis over the notes instead of a full-transcript completion at the very end
+
+    def __init__(self, gateway, note_tokens=150):
+        self.gateway = gateway
+        self.note_tokens = note_tokens
+        self.notes = []  # futures, in turn order
+
+    def __len__(self):
+        return len(self.notes)
+
+    def add_turn(self, question, answer, note=None):
+        # a note that was already written for this answer, e.g. restored from the transcript store, is reused
+        if note is None:
+            prompt = f'{ASSESS_PROMPT}\n\nExaminer: {question}\nMe: {answer}'
+            future = self.gateway.submit([{'role': 'user', 'content': prompt}], temperature=0,
+                                         max_tokens=self.note_tokens)
+        else:
+            future = Future()
+            future.set_result(note)
+        self.notes.append(future)
+        return future
+
+    def synthesize(self):
+        notes = []
+        for i, note in enumerate(self.notes, 1):
+            try:
+                notes.append(f'Answer {i}:\n{note.result()}')
+            except Exception as e:
+                print(f'assessing answer {i} failed: {e}')
+        return self.gateway.stream([{'role': 'user', 'content': f'{SYNTHESIS_PROMPT}\n\n' + '\n\n'.join(notes)}],
+                                   temperature=0.5, top_p=1)
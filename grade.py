@@ -0,0 +1,143 @@
+import argparse
+import asyncio
+import json
+import os
+import sys
+import time
+
+from feedback import FEEDBACK_PROMPT
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+
+
+class RateLimiter:
+    # spaces request starts evenly so a batch stays under the API's requests-per-minute limit
+
+    def __init__(self, per_minute):
+        self.interval = 60 / per_minute if per_minute else 0
+        self.next_start = 0.0
+        self.lock = asyncio.Lock()
+
+    async def wait(self):
+        async with self.lock:
+            now = time.monotonic()
+            if self.next_start > now:
+                await asyncio.sleep(self.next_start - now)
+            self.next_start = max(now, self.next_start) + self.interval
+
+
+def read_transcripts(path):
+    with open(path) as f:
+        for line in f:
+            if line.strip():
+                yield json.loads(line)
+
+
+def graded_sessions(path):
+    # results already on disk from an earlier, possibly interrupted, run
+    if not os.path.exists(path):
+        return set()
+    done = set()
+    with open(path) as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)['session'])
+            except ValueError:
+                pass  # the last line of a run that was killed mid-write
+    return done
+
+
+def grading_messages(app, transcript):
+    # same messages the Get feedback button sends, with the case in front so accuracy can be judged
+    dialogue = '\n'.join(f"{turn['speaker']}: {turn['text']}" for turn in transcript['turns'])
+    return [
+        {'role': 'user', 'content': app.create_prompt(app.CASES, transcript['case'])},
+        {'role': 'user', 'content': dialogue + FEEDBACK_PROMPT},
+    ]
+
+
+async def grade_all(app, gateway, transcripts, out, concurrency, per_minute):
+    limiter = RateLimiter(per_minute)
+    queue = asyncio.Queue()
+    for transcript in transcripts:
+        queue.put_nowait(transcript)
+    totals = {'graded': 0, 'failed': 0, 'prompt_tokens': 0, 'completion_tokens': 0}
+
+    async def worker():
+        while not queue.empty():
+            transcript = queue.get_nowait()
+            messages = grading_messages(app, transcript)
+            await limiter.wait()
+            try:
+                feedback, usage = await gateway.acomplete(messages, with_usage=True, temperature=0.5, top_p=1)
+            except Exception as e:
+                # left out of the output, so the next run retries it
+                totals['failed'] += 1
+                print(f"grading {transcript['session']} failed: {e}", file=sys.stderr)
+                continue
+            prompt_tokens, completion_tokens = usage['prompt_tokens'], usage['completion_tokens']
+            out.write(json.dumps({
+                'session': transcript['session'],
+                'user': transcript.get('user'),
+                'case': transcript['case'],
+                'feedback': feedback,
+                'prompt_tokens': prompt_tokens,
+                'completion_tokens': completion_tokens,
+            }) + '\n')
+            out.flush()
+            totals['graded'] += 1
+            totals['prompt_tokens'] += prompt_tokens
+            totals['completion_tokens'] += completion_tokens
+
+    await asyncio.gather(*(worker() for _ in range(concurrency)))
+    return totals
+
+
+def main(args):
+    os.environ['LLM_BACKEND'] = args.llm
+    # paths on the command line are relative to where grade.py was run from, not the app directory
+    transcripts_path, output = os.path.abspath(args.transcripts), os.path.abspath(args.output)
+    os.chdir(HERE)
+    import app
+    import llm
+
+    done = graded_sessions(output)
+    transcripts, missing = [], []
+    for t in read_transcripts(transcripts_path):
+        if t['session'] in done or not t['turns']:
+            continue
+        # the case was renamed or removed since the session; it can't be graded against its case text
+        (transcripts if t['case'] in app.CASES else missing).append(t)
+    print(f'{len(transcripts)} transcripts to grade ({len(done)} already graded)')
+    if missing:
+        print(f'{len(missing)} transcripts skipped, their case is no longer available: '
+              + ', '.join(f"{t['session']} ({t['case']})" for t in missing), file=sys.stderr)
+    if not transcripts:
+        return
+
+    gateway = llm.get_gateway(args.llm)
+    start = time.perf_counter()
+    with open(output, 'a+') as out:
+        end = out.tell()
+        if end:
+            out.seek(end - 1)
+            if out.read(1) != '\n':
+                out.write('\n')  # don't glue the first new result onto a half-written line
+        totals = asyncio.run_coroutine_threadsafe(
+            grade_all(app, gateway, transcripts, out, args.concurrency, args.rate), gateway.loop).result()
+    elapsed = time.perf_counter() - start
+
+    print(f"graded {totals['graded']} transcripts in {elapsed:.1f}s ({totals['graded'] / elapsed:.2f} transcripts/s), "
+          f"{totals['failed']} failed")
+    print(f"tokens: {totals['prompt_tokens']} prompt, {totals['completion_tokens']} completion "
+          f"({(totals['prompt_tokens'] + totals['completion_tokens']) / elapsed:.0f} tokens/s)")
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Grade exported exam transcripts with the feedback prompt.')
+    parser.add_argument('transcripts', help='JSONL export from transcripts.py')
+    parser.add_argument('-o', '--output', default='grades.jsonl', help='results are appended here; rerun to resume')
+    parser.add_argument('--concurrency', type=int, default=8, help='transcripts graded at once')
+    parser.add_argument('--rate', type=float, default=60, help='requests per minute (0 for no limit)')
+    parser.add_argument('--llm', default='openai', help='LLM backend (openai, or local for testing)')
+    main(parser.parse_args())
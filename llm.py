@@ -0,0 +1,204 @@
+import asyncio
+import os
+import queue
+import random
+import threading
+
+import aiohttp
+import openai
+
+LLM_BACKEND = os.getenv("LLM_BACKEND", "openai")
+LLM_MODEL = os.getenv("LLM_MODEL", "gpt-4")
+LLM_TIMEOUT = float(os.getenv("LLM_TIMEOUT", "60"))  # seconds per request, or between streamed chunks
+LLM_RETRIES = int(os.getenv("LLM_RETRIES", "3"))
+LLM_MAX_CONCURRENCY = int(os.getenv("LLM_MAX_CONCURRENCY", "8"))  # in-flight requests per API key
+# of those, how many drafts, assessments and summaries may hold; the rest stay free for the live examiner
+LLM_BACKGROUND_CONCURRENCY = int(os.getenv("LLM_BACKGROUND_CONCURRENCY", "4"))
+LOCAL_TOKEN_DELAY = float(os.getenv("LOCAL_TOKEN_DELAY", "0"))
+
+RETRYABLE = (
+    asyncio.TimeoutError,
+    aiohttp.ClientError,
+    openai.error.APIConnectionError,
+    openai.error.APIError,
+    openai.error.RateLimitError,
+    openai.error.ServiceUnavailableError,
+    openai.error.Timeout,
+)
+
+_GATEWAYS = {}
+_GATEWAY_LOCK = threading.Lock()
+
+
+class LLMError(Exception):
+    pass
+
+
+class OpenAIBackend:
+    name = 'openai'
+
+    def __init__(self, api_key=None):
+        self.api_key = api_key or os.getenv("OPENAI_API_KEY")
+        self.session = None
+
+    def _session(self):
+        # one pooled HTTP session for every request in the process
+        if self.session is None:
+            connector = aiohttp.TCPConnector(limit=2 * LLM_MAX_CONCURRENCY, keepalive_timeout=60)
+            self.session = aiohttp.ClientSession(connector=connector)
+        openai.aiosession.set(self.session)
+
+    async def complete(self, messages, **params):
+        self._session()
+        response = await openai.ChatCompletion.acreate(api_key=self.api_key, messages=messages, **params)
+        return response['choices'][0]['message']['content'], dict(response['usage'])
+
+    async def stream(self, messages, **params):
+        self._session()
+        response = await openai.ChatCompletion.acreate(api_key=self.api_key, messages=messages, stream=True, **params)
+        async for chunk in response:
+            yield chunk['choices'][0]['delta'].get('content', '')
+
+
+class LocalBackend:
+    # deterministic offline stand-in for the examiner, so the whole turn loop runs without network or API key
+    name = 'local'
+    api_key = 'local'
+
+    def __init__(self, token_delay=LOCAL_TOKEN_DELAY):
+        self.token_delay = token_delay
+
+    def reply(self, messages):
+        answer = next((m['content'] for m in reversed(messages) if m['role'] == 'user'), '')
+        topic = ' '.join(answer.split()[-8:]) or 'this case'
+        return f'Thank you. You mentioned {topic}.\nQuestion: What would you do next, and why?'
+
+    async def complete(self, messages, **params):
+        await asyncio.sleep(self.token_delay)
+        reply = self.reply(messages)
+        # words stand in for tokens
+        usage = {'prompt_tokens': sum(len(m['content'].split()) for m in messages),
+                 'completion_tokens': len(reply.split())}
+        return reply, {**usage, 'total_tokens': usage['prompt_tokens'] + usage['completion_tokens']}
+
+    async def stream(self, messages, **params):
+        for word in self.reply(messages).split(' '):
+            await asyncio.sleep(self.token_delay)
+            yield f'{word} '
+
+
+BACKENDS = {backend.name: backend for backend in (OpenAIBackend, LocalBackend)}
+
+
+class Stream:
+    # starts the request immediately and buffers deltas, so it can be created ahead of time and iterated later
+
+    def __init__(self, gateway, messages, params):
+        self.deltas = queue.Queue()
+        asyncio.run_coroutine_threadsafe(self._pump(gateway, messages, params), gateway.loop)
+
+    async def _pump(self, gateway, messages, params):
+        try:
+            async for delta in gateway.astream(messages, **params):
+                self.deltas.put(delta)
+        except Exception as e:
+            self.deltas.put(e)
+        self.deltas.put(None)
+
+    def __iter__(self):
+        while (delta := self.deltas.get()) is not None:
+            if isinstance(delta, Exception):
+                raise delta
+            yield delta
+
+
+class Gateway:
+    # every LLM request goes through here: one event loop thread per process, a pooled client,
+    # per-request deadlines, jittered exponential backoff and a concurrency cap per API key
+
+    def __init__(self, backend, timeout=LLM_TIMEOUT, retries=LLM_RETRIES, max_concurrency=LLM_MAX_CONCURRENCY,
+                 background_concurrency=LLM_BACKGROUND_CONCURRENCY):
+        self.backend = backend
+        self.timeout = timeout
+        self.retries = retries
+        self.max_concurrency = max_concurrency
+        self.background_concurrency = max(1, min(background_concurrency, max_concurrency - 1))
+        self.limits = {}
+        self.background_limits = {}
+        self.loop = asyncio.new_event_loop()
+        self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+        self.thread.start()
+
+    def _limit(self):
+        key = self.backend.api_key
+        if key not in self.limits:
+            self.limits[key] = asyncio.Semaphore(self.max_concurrency)
+        return self.limits[key]
+
+    def _background_limit(self):
+        key = self.backend.api_key
+        if key not in self.background_limits:
+            self.background_limits[key] = asyncio.Semaphore(self.background_concurrency)
+        return self.background_limits[key]
+
+    async def _backoff(self, attempt, error):
+        if attempt >= self.retries:
+            raise LLMError(f'LLM request failed after {attempt + 1} attempts: {error!r}') from error
+        await asyncio.sleep(random.uniform(0, min(8.0, 0.5 * 2 ** attempt)))
+
+    async def acomplete(self, messages, with_usage=False, background=False, **params):
+        # with_usage returns (text, usage) with the token counts the API billed. Background requests also wait
+        # for one of the key's fewer background slots, so they can never take every slot from a live reply
+        if background:
+            async with self._background_limit():
+                return await self.acomplete(messages, with_usage, **params)
+        params = {'model': LLM_MODEL, **params}
+        async with self._limit():
+            for attempt in range(self.retries + 1):
+                try:
+                    text, usage = await asyncio.wait_for(self.backend.complete(messages, **params), self.timeout)
+                    return (text, usage) if with_usage else text
+                except RETRYABLE as e:
+                    await self._backoff(attempt, e)
+                except openai.error.OpenAIError as e:
+                    raise LLMError(str(e)) from e
+
+    async def astream(self, messages, **params):
+        params = {'model': LLM_MODEL, **params}
+        async with self._limit():
+            for attempt in range(self.retries + 1):
+                stream = self.backend.stream(messages, **params)
+                started = False
+                try:
+                    while True:
+                        delta = await asyncio.wait_for(stream.__anext__(), self.timeout)
+                        started = True
+                        yield delta
+                except StopAsyncIteration:
+                    return
+                except RETRYABLE as e:
+                    # once text has reached the caller a retry would repeat it
+                    if started:
+                        raise LLMError(f'LLM stream interrupted: {e!r}') from e
+                    await self._backoff(attempt, e)
+                except openai.error.OpenAIError as e:
+                    raise LLMError(str(e)) from e
+
+    def complete(self, messages, **params):
+        return asyncio.run_coroutine_threadsafe(self.acomplete(messages, **params), self.loop).result()
+
+    def submit(self, messages, background=True, **params):
+        # fire-and-forget completion, a background request by default; returns a concurrent.futures.Future
+        return asyncio.run_coroutine_threadsafe(self.acomplete(messages, background=background, **params), self.loop)
+
+    def stream(self, messages, **params):
+        return Stream(self, messages, params)
+
+
+def get_gateway(backend=LLM_BACKEND):
+    with _GATEWAY_LOCK:
+        if backend not in _GATEWAYS:
+            if backend not in BACKENDS:
+                raise ValueError(f'unknown LLM backend {backend!r}, expected one of {sorted(BACKENDS)}')
+            _GATEWAYS[backend] = Gateway(BACKENDS[backend]())
+        return _GATEWAYS[backend]
@@ -0,0 +1,184 @@
+import threading
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+_SUMMARY_POOL = ThreadPoolExecutor(max_workers=4, thread_name_prefix='summary')
+_TOKENIZER = None
+_TOKENIZER_LOCK = threading.Lock()
+
+
+def get_tokenizer():
+    # one GPT-2 tokenizer for the whole process; transformers is only imported on first use
+    global _TOKENIZER
+    with _TOKENIZER_LOCK:
+        if _TOKENIZER is None:
+            from transformers import GPT2TokenizerFast
+            _TOKENIZER = GPT2TokenizerFast.from_pretrained("gpt2")
+        return _TOKENIZER
+
+
+def count_tokens(text):
+    return len(get_tokenizer()(text)['input_ids'])
+
+
+class TokenBuffer:
+    # a message list that counts each message's tokens once, on append, and drops the oldest
+    # messages when the running total goes over max_tokens
+
+    def __init__(self, max_tokens, count, text=lambda item: item, items=()):
+        self.max_tokens = max_tokens
+        self.count = count
+        self.text = text
+        self.items = deque()
+        self.counts = deque()
+        self.tokens = 0
+        for item in items:
+            self.append(item)
+
+    def append(self, item):
+        n = self.count(self.text(item))
+        self.items.append(item)
+        self.counts.append(n)
+        self.tokens += n
+        # always keep the newest message, even if it alone is over budget
+        while self.tokens > self.max_tokens and len(self.items) > 1:
+            self.popleft()
+
+    def restore(self, items, summary=None):
+        # there are no summaries to restore here, old messages are dropped as they are appended
+        for item in items:
+            self.append(item)
+
+    def pop(self):
+        self.tokens -= self.counts.pop()
+        return self.items.pop()
+
+    def popleft(self):
+        self.tokens -= self.counts.popleft()
+        return self.items.popleft()
+
+    def __iter__(self):
+        return iter(self.items)
+
+    def __len__(self):
+        return len(self.items)
+
+    def __getitem__(self, index):
+        return self.items[index]
+
+    def to_list(self):
+        return list(self.items)
+
+
+class CompactingBuffer:
+    # keeps the pinned prefix (case instructions) forever and folds the oldest turns into a rolling
+    # summary on a background thread once the prompt reaches compact_at of the budget
+
+    def __init__(self, pinned, max_tokens, count, summarize, text=lambda item: item['content'],
+                 compact_at=0.75, executor=None, pinned_tokens=None, on_summary=None):
+        self.max_tokens = max_tokens
+        self.count = count
+        self.summarize = summarize
+        self.text = text
+        self.compact_at = compact_at
+        self.executor = executor or _SUMMARY_POOL
+        self.on_summary = on_summary  # called with the new summary and how many more turns it covers
+        self.pinned = list(pinned)
+        if pinned_tokens is None:
+            pinned_tokens = sum(count(text(item)) for item in self.pinned)
+        self.pinned_tokens = pinned_tokens
+        self.summary = None
+        self.summary_tokens = 0
+        self.turns = deque()  # (sequence number, item, tokens)
+        self.turn_tokens = 0
+        self.next_seq = 0
+        self.folding = None  # (last sequence number being folded, future, number of turns being folded)
+
+    @property
+    def tokens(self):
+        return self.pinned_tokens + self.summary_tokens + self.turn_tokens
+
+    def append(self, item):
+        n = self.count(self.text(item))
+        self.turns.append((self.next_seq, item, n))
+        self.next_seq += 1
+        self.turn_tokens += n
+        self._collect()
+        if self.folding is None and self.tokens > self.compact_at * self.max_tokens and len(self.turns) > 2:
+            self._fold()
+        # over budget before the summary is back: only drop turns the pending summary covers, then wait for it,
+        # and fold again if that wasn't enough
+        while self.tokens > self.max_tokens and len(self.turns) > 1:
+            if self.folding is None:
+                self._fold()
+                if self.folding is None:
+                    self.popleft()  # nothing left to fold but the latest exchange
+                    continue
+            if self.turns[0][0] <= self.folding[0]:
+                self.popleft()
+            else:
+                self._collect(wait=True)
+
+    def restore(self, items, summary=None):
+        # reload a stored conversation, and the summary that replaced its first covered turns, without
+        # summarizing anything; the next append compacts it if it's still over budget
+        if summary is not None:
+            content, covered = summary
+            self.summary = {'role': 'system', 'content': content}
+            self.summary_tokens = self.count(self.text(self.summary))
+            items = items[covered:]
+        for item in items:
+            n = self.count(self.text(item))
+            self.turns.append((self.next_seq, item, n))
+            self.next_seq += 1
+            self.turn_tokens += n
+
+    def pop(self):
+        _, item, n = self.turns.pop()
+        self.turn_tokens -= n
+        return item
+
+    def popleft(self):
+        _, item, n = self.turns.popleft()
+        self.turn_tokens -= n
+        return item
+
+    def _fold(self):
+        # fold roughly the older half of the turns, never the latest exchange
+        fold, tokens = [], 0
+        for seq, item, n in list(self.turns)[:-2]:
+            if tokens >= self.turn_tokens / 2:
+                break
+            fold.append((seq, item))
+            tokens += n
+        if fold:
+            previous = self.summary['content'] if self.summary else None
+            future = self.executor.submit(self.summarize, previous, [item for _, item in fold])
+            self.folding = (fold[-1][0], future, len(fold))
+
+    def _collect(self, wait=False):
+        if self.folding is None or not (wait or self.folding[1].done()):
+            return
+        last, future, folded = self.folding
+        self.folding = None
+        try:
+            summary = future.result()
+        except Exception as e:
+            print(f'summarizing the conversation failed: {e}')
+            return
+        self.summary = {'role': 'system', 'content': f'Summary of the exam so far: {summary}'}
+        self.summary_tokens = self.count(self.text(self.summary))
+        while self.turns and self.turns[0][0] <= last:
+            self.popleft()
+        if self.on_summary:
+            self.on_summary(self.summary, folded)
+
+    def __iter__(self):
+        return iter(self.to_list())
+
+    def __len__(self):
+        return len(self.pinned) + (self.summary is not None) + len(self.turns)
+
+    def to_list(self):
+        self._collect()
+        return self.pinned + ([self.summary] if self.summary else []) + [item for _, item, _ in self.turns]
@@ -0,0 +1,20 @@
+import pandas as pd
+import streamlit as st
+
+import tracing
+
+st.title('Voice loop latency')
+st.caption('Per-stage latency across all sessions, from the traces written by the exam.')
+
+records = tracing.load()
+if not records:
+    st.write(f'No traces in `{tracing.TRACE_FILE}` yet. Run a case first.')
+    st.stop()
+
+sessions = {record['session'] for record in records}
+st.write(f'{len(records)} most recent spans (up to `TRACE_WINDOW`) from {len(sessions)} sessions.')
+
+summary = pd.DataFrame(tracing.summarize(records)).T
+summary[['p50', 'p95']] = (summary[['p50', 'p95']] * 1000).round(0)
+summary = summary.rename(columns={'p50': 'p50 (ms)', 'p95': 'p95 (ms)'}).sort_values('p95 (ms)', ascending=False)
+st.dataframe(summary)
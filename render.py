@@ -0,0 +1,57 @@
+import os
+import time
+
+RENDER_INTERVAL = float(os.getenv("RENDER_INTERVAL", "0.1"))  # seconds between UI updates while streaming
+RENDER_CHARS = int(os.getenv("RENDER_CHARS", "400"))  # or sooner, once this much new text is buffered
+
+
+class StreamRenderer:
+    # buffers streamed text and redraws the placeholder at most every `interval` seconds (or every `chars`
+    # new characters), instead of re-rendering the whole growing markdown on every token
+
+    def __init__(self, placeholder, prefix='', interval=RENDER_INTERVAL, chars=RENDER_CHARS):
+        self.placeholder = placeholder
+        self.prefix = prefix
+        self.interval = interval
+        self.chars = chars
+        self.parts = []
+        self.pending = 0
+        self.chunks = 0
+        self.flushes = 0
+        self.render_seconds = 0.0
+        self.start = time.perf_counter()
+        self.last_flush = self.start
+
+    @property
+    def text(self):
+        return ''.join(self.parts)
+
+    def feed(self, delta):
+        self.parts.append(delta)
+        self.chunks += 1
+        self.pending += len(delta)
+        if self.pending >= self.chars or time.perf_counter() - self.last_flush >= self.interval:
+            self.flush()
+
+    def flush(self):
+        start = time.perf_counter()
+        text = self.text
+        self.parts = [text]
+        self.placeholder.write(f'{self.prefix}{text}')
+        self.last_flush = time.perf_counter()
+        self.render_seconds += self.last_flush - start
+        self.pending = 0
+        self.flushes += 1
+
+    def close(self):
+        self.flush()
+        return self.text
+
+    def stats(self):
+        elapsed = time.perf_counter() - self.start
+        return {
+            'chunks': self.chunks,
+            'flushes': self.flushes,
+            'chunk_rate': self.chunks / elapsed if elapsed else 0.0,
+            'render_seconds': self.render_seconds,
+        }
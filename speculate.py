@@ -0,0 +1,99 @@
+import os
+import re
+import time
+from concurrent.futures import ThreadPoolExecutor
+from difflib import SequenceMatcher
+
+import tts
+
+SPECULATE = os.getenv("SPECULATE", "0") == "1"
+SPECULATE_SIMILARITY = float(os.getenv("SPECULATE_SIMILARITY", "0.85"))  # partial vs final answer, to commit a draft
+SPECULATE_MIN_WORDS = int(os.getenv("SPECULATE_MIN_WORDS", "4"))  # new words in the partial before redrafting
+
+_PREWARM_POOL = ThreadPoolExecutor(max_workers=2, thread_name_prefix='prewarm')
+
+
+def words(text):
+    return re.findall(r"[a-z0-9']+", text.lower())
+
+
+def prewarm(sentences):
+    # synthesize into the speech cache in the background, so saying them later is a cache hit
+    for sentence in sentences:
+        _PREWARM_POOL.submit(tts.synthesize, sentence)
+
+
+class Speculator:
+    # drafts the examiner's reply from the live transcript while the resident is still talking. Each time the
+    # partial grows by min_words the draft is restarted, so the latest draft tracks the answer; at end of speech
+    # it is used if the final transcript is close enough to the partial it was written for
+
+    def __init__(self, gateway, tracer, prompt, similarity=SPECULATE_SIMILARITY, min_words=SPECULATE_MIN_WORDS,
+                 prepare=lambda sentence: sentence, timeout=30, **params):
+        self.gateway = gateway
+        self.tracer = tracer
+        self.prompt = prompt
+        self.similarity = similarity
+        self.min_words = min_words
+        self.prepare = prepare
+        self.timeout = timeout
+        self.params = params
+        self.draft = None  # (partial, future, started)
+        self.finished = {}
+        self.drafts = 0
+        self.hits = 0
+        self.misses = 0
+        self.saved_seconds = 0.0
+
+    def update(self, partial, memory):
+        n = len(words(partial))
+        if n < self.min_words or (self.draft and n - len(words(self.draft[0])) < self.min_words):
+            return
+        self.cancel()
+        messages = memory + [{'role': 'user', 'content': partial}, {'role': 'system', 'content': self.prompt}]
+        future = self.gateway.submit(messages, **self.params)
+        future.add_done_callback(self._done)
+        self.draft = (partial, future, time.perf_counter())
+        self.drafts += 1
+
+    def _done(self, future):
+        self.finished[future] = time.perf_counter()
+        if future.cancelled() or future.exception():
+            return
+        # the first sentence is what gets spoken first on a hit
+        splitter = tts.SentenceSplitter()
+        first = (splitter.feed(future.result()) + splitter.flush())[:1]
+        prewarm(self.prepare(sentence) for sentence in first)
+
+    def cancel(self):
+        if self.draft:
+            self.draft[1].cancel()
+            self.finished.pop(self.draft[1], None)
+            self.draft = None
+
+    def take(self, final):
+        # the draft for this answer, or None if there is none or the answer changed too much since
+        if self.draft is None:
+            return None
+        partial, future, started = self.draft
+        ended = time.perf_counter()
+        similarity = SequenceMatcher(None, words(partial), words(final)).ratio()
+        text = None
+        if similarity >= self.similarity:
+            try:
+                text = future.result(timeout=self.timeout)
+            except Exception as e:
+                print(f'speculative draft failed: {e}')
+        if text is None:
+            self.cancel()
+            self.misses += 1
+            self.tracer.record('speculation', 0.0, hit=False, similarity=similarity)
+            return None
+        # generation time that overlapped the resident still talking
+        saved = min(self.finished.pop(future, ended), ended) - started
+        self.draft = None
+        self.hits += 1
+        self.saved_seconds += saved
+        self.tracer.record('speculation', saved, hit=True, similarity=similarity)
+        return text
+
@@ -0,0 +1,146 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import defaultdict, deque
+from contextlib import contextmanager
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+
+TRACE_FILE = os.getenv("TRACE_FILE", "traces.jsonl")
+TRACE_MAX_MB = float(os.getenv("TRACE_MAX_MB", "20"))  # the trace file is rotated to <TRACE_FILE>.1 past this size
+TRACE_WINDOW = int(os.getenv("TRACE_WINDOW", "20000"))  # most recent spans the Latency page summarizes
+METRICS_PORT = int(os.getenv("METRICS_PORT", "0"))  # 0 disables the Prometheus endpoint
+
+_SINK = None
+_SINK_LOCK = threading.Lock()
+
+
+class TraceSink:
+    # appends spans to a JSONL file from a writer thread and keeps recent durations per stage in memory
+
+    def __init__(self, path=TRACE_FILE, window=2000, max_mb=TRACE_MAX_MB):
+        self.path = path
+        self.window = window
+        self.max_bytes = max_mb * 1024 * 1024
+        self.records = queue.Queue()
+        self.durations = defaultdict(lambda: deque(maxlen=window))
+        self.counts = defaultdict(int)
+        self.totals = defaultdict(float)
+        self.lock = threading.Lock()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def emit(self, record):
+        with self.lock:
+            self.durations[record['stage']].append(record['seconds'])
+            self.counts[record['stage']] += 1
+            self.totals[record['stage']] += record['seconds']
+        self.records.put(record)
+
+    def _write(self):
+        while True:
+            records = [self.records.get()]
+            while not self.records.empty():
+                records.append(self.records.get())
+            if self.path:
+                with open(self.path, 'a') as f:
+                    f.writelines(json.dumps(record) + '\n' for record in records)
+                    size = f.tell()
+                # keep one previous file, so traces never take more than twice max_mb on disk
+                if self.max_bytes and size > self.max_bytes:
+                    os.replace(self.path, self.path + '.1')
+
+    def prometheus(self):
+        lines = [
+            '# HELP exam_stage_seconds Latency of each stage of the voice loop.',
+            '# TYPE exam_stage_seconds summary',
+        ]
+        with self.lock:
+            for stage, durations in sorted(self.durations.items()):
+                for q in (0.5, 0.95):
+                    lines.append(f'exam_stage_seconds{{stage="{stage}",quantile="{q}"}} {np.quantile(durations, q):.6f}')
+                lines.append(f'exam_stage_seconds_sum{{stage="{stage}"}} {self.totals[stage]:.6f}')
+                lines.append(f'exam_stage_seconds_count{{stage="{stage}"}} {self.counts[stage]}')
+        return '\n'.join(lines) + '\n'
+
+
+class Tracer:
+
+    def __init__(self, session_id, case_id, sink=None):
+        self.session_id = session_id
+        self.case_id = case_id
+        self.sink = sink or get_sink()
+        self.turn = 0
+
+    def record(self, stage, seconds, **attrs):
+        self.sink.emit({
+            'time': time.time(),
+            'session': self.session_id,
+            'case': self.case_id,
+            'turn': self.turn,
+            'stage': stage,
+            'seconds': seconds,
+            **attrs,
+        })
+
+    @contextmanager
+    def span(self, stage, **attrs):
+        # the caller can add attributes (token counts, audio durations) to the yielded dict
+        start = time.perf_counter()
+        try:
+            yield attrs
+        finally:
+            self.record(stage, time.perf_counter() - start, **attrs)
+
+
+def load(path=TRACE_FILE, limit=TRACE_WINDOW):
+    # only the last limit spans are parsed
+    if not os.path.exists(path):
+        return []
+    with open(path) as f:
+        lines = deque(f, maxlen=limit)
+    return [json.loads(line) for line in lines if line.strip()]
+
+
+def summarize(records):
+    stages = defaultdict(list)
+    for record in records:
+        stages[record['stage']].append(record['seconds'])
+    return {
+        stage: {
+            'count': len(durations),
+            'p50': float(np.percentile(durations, 50)),
+            'p95': float(np.percentile(durations, 95)),
+        }
+        for stage, durations in stages.items()
+    }
+
+
+def serve(sink, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_GET(self):
+            body = sink.prometheus().encode()
+            self.send_response(200 if self.path == '/metrics' else 404)
+            self.send_header('Content-Type', 'text/plain; version=0.0.4')
+            self.end_headers()
+            if self.path == '/metrics':
+                self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = ThreadingHTTPServer(('127.0.0.1', port), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def get_sink():
+    global _SINK
+    with _SINK_LOCK:
+        if _SINK is None:
+            _SINK = TraceSink()
+            if METRICS_PORT:
+                serve(_SINK, METRICS_PORT)
+        return _SINK
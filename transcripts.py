@@ -0,0 +1,147 @@
+import argparse
+import json
+import os
+import queue
+import sqlite3
+import sys
+import threading
+import time
+
+TRANSCRIPT_DB = os.getenv("TRANSCRIPT_DB", "transcripts.sqlite")  # empty disables persistence
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS sessions (
+    session TEXT PRIMARY KEY, user TEXT, case_id TEXT, started REAL, updated REAL
+);
+CREATE INDEX IF NOT EXISTS sessions_user ON sessions (user);
+CREATE INDEX IF NOT EXISTS sessions_case ON sessions (case_id);
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, session TEXT, time REAL, kind TEXT, role TEXT, content TEXT
+);
+CREATE INDEX IF NOT EXISTS events_session ON events (session, id);
+'''
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+class TranscriptStore:
+    # append-only log of every session: transcript lines ('turn'), the messages kept in the LLM memory
+    # ('message'), the rolling summary that replaced the oldest of them ('summary', role = messages covered) and
+    # each answer's assessment ('note', role = answer number). Writes are queued and committed in batches by a
+    # writer thread, off the voice loop.
+
+    def __init__(self, path=TRANSCRIPT_DB):
+        self.path = path
+        db = self.connect()
+        db.executescript(SCHEMA)
+        db.close()
+        self.pending = queue.Queue()
+        threading.Thread(target=self._write, daemon=True).start()
+
+    def connect(self):
+        db = sqlite3.connect(self.path, timeout=30)
+        db.execute('PRAGMA journal_mode=WAL')
+        db.execute('PRAGMA synchronous=NORMAL')
+        return db
+
+    def start(self, session, case_id, user=None):
+        now = time.time()
+        self.pending.put(('INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?, ?)', (session, user, case_id, now, now)))
+
+    def append(self, session, kind, role, content):
+        # events are ordered by their rowid, which the single writer thread assigns in queue order
+        now = time.time()
+        self.pending.put(('INSERT INTO events (session, time, kind, role, content) VALUES (?, ?, ?, ?, ?)',
+                          (session, now, kind, role, content)))
+        self.pending.put(('UPDATE sessions SET updated = ? WHERE session = ?', (now, session)))
+
+    def _write(self):
+        db = self.connect()
+        while True:
+            writes = [self.pending.get()]
+            while not self.pending.empty():
+                writes.append(self.pending.get())
+            try:
+                with db:
+                    for sql, params in writes:
+                        db.execute(sql, params)
+            except sqlite3.Error as e:
+                # a failed batch is rolled back and lost, but the writer keeps going and flush() still returns
+                print(f'writing {len(writes)} transcript events failed: {e}')
+            finally:
+                for _ in writes:
+                    self.pending.task_done()
+
+    def flush(self):
+        self.pending.join()
+
+    def session(self, session):
+        db = self.connect()
+        try:
+            row = db.execute('SELECT user, case_id, started FROM sessions WHERE session = ?', (session,)).fetchone()
+        finally:
+            db.close()
+        return None if row is None else {'session': session, 'user': row[0], 'case': row[1], 'started': row[2]}
+
+    def events(self, session):
+        db = self.connect()
+        try:
+            return db.execute('SELECT time, kind, role, content FROM events WHERE session = ? ORDER BY id',
+                              (session,)).fetchall()
+        finally:
+            db.close()
+
+    def sessions(self, user=None, case_id=None, since=None):
+        where, params = [], []
+        for column, value in (('user', user), ('case_id', case_id)):
+            if value is not None:
+                where.append(f'{column} = ?')
+                params.append(value)
+        if since is not None:
+            where.append('started >= ?')
+            params.append(since)
+        sql = 'SELECT session, user, case_id, started FROM sessions'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        db = self.connect()
+        try:
+            return [{'session': s, 'user': u, 'case': c, 'started': t}
+                    for s, u, c, t in db.execute(sql + ' ORDER BY started', params)]
+        finally:
+            db.close()
+
+    def export(self, f, **filters):
+        # one transcript per line, for offline grading and analysis
+        n = 0
+        for session in self.sessions(**filters):
+            session['turns'] = [{'time': t, 'speaker': role, 'text': content}
+                                for t, kind, role, content in self.events(session['session']) if kind == 'turn']
+            f.write(json.dumps(session) + '\n')
+            n += 1
+        return n
+
+
+def get_store():
+    global _STORE
+    with _STORE_LOCK:
+        if _STORE is None and TRANSCRIPT_DB:
+            _STORE = TranscriptStore()
+        return _STORE
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Export stored exam transcripts as JSON lines.')
+    parser.add_argument('output', help='JSONL file to write, or - for stdout')
+    parser.add_argument('--db', default=TRANSCRIPT_DB)
+    parser.add_argument('--user')
+    parser.add_argument('--case', dest='case_id')
+    args = parser.parse_args()
+
+    store = TranscriptStore(args.db)
+    if args.output == '-':
+        store.export(sys.stdout, user=args.user, case_id=args.case_id)
+    else:
+        with open(args.output, 'w') as f:
+            n = store.export(f, user=args.user, case_id=args.case_id)
+        print(f'exported {n} sessions to {args.output}')
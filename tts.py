@@ -0,0 +1,292 @@
+import hashlib
+import io
+import os
+import queue
+import re
+import tempfile
+import threading
+import time
+import wave
+from collections import OrderedDict
+
+SENTENCE_END = re.compile(r'(?<=[.!?])\s+')
+TTS_BACKEND = os.getenv("TTS_BACKEND", "gtts")
+TTS_VOICE = os.getenv("TTS_VOICE", "en")
+TTS_LOCAL_VOICE = os.getenv("TTS_LOCAL_VOICE")
+TTS_CACHE_DIR = os.getenv("TTS_CACHE_DIR", ".tts_cache")
+TTS_CACHE_MEMORY_MB = float(os.getenv("TTS_CACHE_MEMORY_MB", "64"))
+TTS_CACHE_DISK_MB = float(os.getenv("TTS_CACHE_DISK_MB", "512"))
+
+_CACHE = None
+_BACKENDS = {}
+_CACHE_LOCK = threading.Lock()
+
+
+def read_wav(path):
+    from pydub import AudioSegment
+
+    with wave.open(path) as w:
+        return AudioSegment(data=w.readframes(w.getnframes()), sample_width=w.getsampwidth(),
+                            frame_rate=w.getframerate(), channels=w.getnchannels())
+
+
+def play(clip):
+    # pydub (and its audio player lookup) is only imported once there is something to play
+    from pydub.playback import play as play_clip
+
+    play_clip(clip)
+
+
+class GoogleBackend:
+    # Google text-to-speech over HTTP; returns MP3 that has to be decoded
+    name = 'gtts'
+
+    def __init__(self, voice=TTS_VOICE):
+        self.voice = voice
+
+    def synthesize(self, text):
+        import gtts
+        from pydub import AudioSegment
+
+        audio = io.BytesIO()
+        gtts.gTTS(text=text, lang=self.voice).write_to_fp(audio)
+        audio.seek(0)
+        return AudioSegment.from_file(audio, format="mp3")
+
+
+class LocalBackend:
+    # offline synthesis through pyttsx3 (espeak on Linux, SAPI5 on Windows, NSSpeech on macOS), rendered to PCM WAV
+    name = 'pyttsx3'
+
+    def __init__(self, voice=TTS_LOCAL_VOICE):
+        import pyttsx3
+
+        self.voice = voice or 'default'
+        self.engine = pyttsx3.init()
+        if voice:
+            self.engine.setProperty('voice', voice)
+        # pyttsx3 drives a single native engine that can't be used from two threads at once
+        self.lock = threading.Lock()
+
+    def synthesize(self, text):
+        fd, path = tempfile.mkstemp(suffix='.wav')
+        os.close(fd)
+        try:
+            with self.lock:
+                self.engine.save_to_file(text, path)
+                self.engine.runAndWait()
+            return read_wav(path)
+        finally:
+            os.remove(path)
+
+
+class SilentBackend:
+    # renders silence as long as the sentence would take to say; for headless runs and benchmarks
+    name = 'silent'
+    voice = 'none'
+    seconds_per_word = 0.3
+
+    def synthesize(self, text):
+        from pydub import AudioSegment
+
+        return AudioSegment.silent(duration=1000 * self.seconds_per_word * len(text.split()), frame_rate=16000)
+
+
+BACKENDS = {backend.name: backend for backend in (GoogleBackend, LocalBackend, SilentBackend)}
+
+
+def get_backend(name=TTS_BACKEND):
+    with _CACHE_LOCK:
+        if name not in _BACKENDS:
+            if name not in BACKENDS:
+                raise ValueError(f'unknown TTS backend {name!r}, expected one of {sorted(BACKENDS)}')
+            _BACKENDS[name] = BACKENDS[name]()
+        return _BACKENDS[name]
+
+
+class SpeechCache:
+    # decoded PCM keyed by a hash of (engine, voice, text); an in-memory LRU in front of an on-disk LRU of WAV files
+
+    def __init__(self, directory=TTS_CACHE_DIR, memory_mb=TTS_CACHE_MEMORY_MB, disk_mb=TTS_CACHE_DISK_MB):
+        self.directory = directory
+        self.memory_limit = memory_mb * 2**20
+        self.disk_limit = disk_mb * 2**20
+        self.memory = OrderedDict()
+        self.memory_size = 0
+        self.disk = OrderedDict()
+        self.disk_size = 0
+        self.hits = {'memory': 0, 'disk': 0}
+        self.misses = 0
+        self.lock = threading.Lock()
+        if os.path.isdir(directory):
+            files = [os.path.join(directory, name) for name in os.listdir(directory) if name.endswith('.wav')]
+            for path in sorted(files, key=os.path.getmtime):
+                self.disk[os.path.basename(path)[:-4]] = os.path.getsize(path)
+            self.disk_size = sum(self.disk.values())
+
+    @staticmethod
+    def key(text, voice, engine):
+        text = ' '.join(text.split())  # whitespace differences don't change the audio
+        return hashlib.sha256(f'{engine}\0{voice}\0{text}'.encode()).hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.directory, f'{key}.wav')
+
+    def get(self, key):
+        with self.lock:
+            if key in self.memory:
+                self.memory.move_to_end(key)
+                self.hits['memory'] += 1
+                return self.memory[key]
+            on_disk = key in self.disk
+            if on_disk:
+                self.disk.move_to_end(key)
+        if not on_disk:
+            with self.lock:
+                self.misses += 1
+            return None
+
+        try:
+            segment = read_wav(self.path(key))
+            os.utime(self.path(key))
+        except (OSError, wave.Error, EOFError):
+            with self.lock:
+                self.disk_size -= self.disk.pop(key, 0)
+                self.misses += 1
+            return None
+        with self.lock:
+            self.hits['disk'] += 1
+            self._remember(key, segment)
+        return segment
+
+    def put(self, key, segment):
+        os.makedirs(self.directory, exist_ok=True)
+        tmp = f'{self.path(key)}.{threading.get_ident()}.tmp'
+        with wave.open(tmp, 'wb') as w:
+            w.setnchannels(segment.channels)
+            w.setsampwidth(segment.sample_width)
+            w.setframerate(segment.frame_rate)
+            w.writeframes(segment.raw_data)
+        os.replace(tmp, self.path(key))
+
+        with self.lock:
+            self._remember(key, segment)
+            self.disk_size += os.path.getsize(self.path(key)) - self.disk.pop(key, 0)
+            self.disk[key] = os.path.getsize(self.path(key))
+            while self.disk_size > self.disk_limit and len(self.disk) > 1:
+                old, size = self.disk.popitem(last=False)
+                self.disk_size -= size
+                try:
+                    os.remove(self.path(old))
+                except OSError:
+                    pass
+
+    def _remember(self, key, segment):
+        self.memory_size += len(segment.raw_data) - (len(self.memory[key].raw_data) if key in self.memory else 0)
+        self.memory[key] = segment
+        self.memory.move_to_end(key)
+        while self.memory_size > self.memory_limit and len(self.memory) > 1:
+            _, old = self.memory.popitem(last=False)
+            self.memory_size -= len(old.raw_data)
+
+    def stats(self):
+        lookups = self.hits['memory'] + self.hits['disk'] + self.misses
+        return {
+            'memory_hits': self.hits['memory'],
+            'disk_hits': self.hits['disk'],
+            'misses': self.misses,
+            'hit_rate': (lookups - self.misses) / lookups if lookups else 0.0,
+            'memory_mb': self.memory_size / 2**20,
+            'disk_mb': self.disk_size / 2**20,
+        }
+
+
+def get_cache():
+    global _CACHE
+    with _CACHE_LOCK:
+        if _CACHE is None:
+            _CACHE = SpeechCache()
+        return _CACHE
+
+
+def synthesize(text, backend=None, cache=True):
+    backend = backend or get_backend()
+    key = SpeechCache.key(text, backend.voice, backend.name)
+    if cache:
+        segment = get_cache().get(key)
+        if segment is not None:
+            return segment
+
+    segment = backend.synthesize(text)
+    if cache:
+        get_cache().put(key, segment)
+    return segment
+
+
+class SentenceSplitter:
+
+    def __init__(self):
+        self.buffer = ''
+
+    def feed(self, text):
+        self.buffer += text
+        *sentences, self.buffer = SENTENCE_END.split(self.buffer)
+        return [s.strip() for s in sentences if s.strip()]
+
+    def flush(self):
+        sentence, self.buffer = self.buffer.strip(), ''
+        return [sentence] if sentence else []
+
+
+class SpeechPipeline:
+    # synthesizes sentences on one thread and plays them on another, so sentence 1 plays
+    # while sentence 2 is still being generated and synthesized
+
+    def __init__(self, start=None, synthesize=synthesize, play=play):
+        self.start = start or time.perf_counter()
+        self.synthesize = synthesize
+        self.play = play
+        self.first_audio = None
+        self.synthesis_seconds = 0.0
+        self.audio_seconds = 0.0
+        self.sentences = queue.Queue()
+        self.clips = queue.Queue()
+        self.threads = [
+            threading.Thread(target=self._synthesize_worker, daemon=True),
+            threading.Thread(target=self._play_worker, daemon=True),
+        ]
+
+    def __enter__(self):
+        for thread in self.threads:
+            thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.sentences.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def put(self, sentence):
+        self.sentences.put(sentence)
+
+    @property
+    def time_to_first_audio(self):
+        return None if self.first_audio is None else self.first_audio - self.start
+
+    def _synthesize_worker(self):
+        while (sentence := self.sentences.get()) is not None:
+            try:
+                start = time.perf_counter()
+                clip = self.synthesize(sentence)
+                self.synthesis_seconds += time.perf_counter() - start
+                self.audio_seconds += clip.duration_seconds
+                self.clips.put(clip)
+            except Exception as e:
+                print(f'speech synthesis failed: {e}')
+        self.clips.put(None)
+
+    def _play_worker(self):
+        while (clip := self.clips.get()) is not None:
+            if self.first_audio is None:
+                self.first_audio = time.perf_counter()
+            self.play(clip)